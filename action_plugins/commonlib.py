@@ -2,29 +2,44 @@ import collections
 import copy
 
 
+def vms_of(inject, dom0):
+    '''Return the VMs of dom0, as (host name, hostvars) pairs, in inventory order.
+
+    The inventory is walked anew every time, since every action runs
+    in a worker process of its own, and hostvars may have changed.
+    '''
+    hostvars = inject["hostvars"]
+    vms = []
+    for invhostname in inject["groups"]["all"]:
+        vars = hostvars[invhostname]
+        if vars.get("qubes", {}).get("dom0_vm") == dom0:
+            vms.append((invhostname, vars))
+    return vms
+
+
 def inject_qubes(inject):
     myname = inject["inventory_hostname"]
     akk = collections.OrderedDict()
     all_pcidevs = dict()
-    for invhostname in inject["groups"]["all"]:
+    for invhostname, hostvars in vms_of(inject, myname):
         if invhostname == myname:
             continue
-        hostvars = inject["hostvars"][invhostname]
-        if hostvars.get("qubes", {}).get("dom0_vm") == myname:
-            akk[invhostname] = copy.deepcopy(hostvars)
+        # Only the qubes attribute changes below, so only it is copied.
+        akk[invhostname] = collections.ChainMap(
+            {"qubes": copy.deepcopy(hostvars["qubes"])}, hostvars
+        )
     for invhostname, hostvars in akk.items():
         qubes = hostvars["qubes"]
         dominv = qubes["dom0_vm"]
         for dev in qubes.get("pcidevs", []):
-            if all_pcidevs.get(dev):
-                assert t in akk, (
-                    "while processing attribute pcidevs of VM %s: "
-                    "device %s already in use by VM %s"
-                ) % (
-                    invhostname,
-                    dev,
-                    all_pcidevs[dev],
-                )
+            assert not all_pcidevs.get(dev), (
+                "while processing attribute pcidevs of VM %s: "
+                "device %s already in use by VM %s"
+            ) % (
+                invhostname,
+                dev,
+                all_pcidevs[dev],
+            )
             all_pcidevs[dev] = invhostname
         for vmitem in ["template_vm", "netvm_vm"]:
             if vmitem == "template_vm":
@@ -1,8 +1,90 @@
+from ansible.errors import AnsibleActionFail
+from ansible.module_utils.common.text.converters import to_text
 from ansible.plugins.action import ActionBase
-import errno
-import os
-import re
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import collections.abc
 import subprocess
+import time
+
+# qvm-pass exits with this when there is no such entry.
+ABSENT = 8
+
+
+def get(name):
+    '''Return the contents of entry name, or None if there is no such entry.'''
+    cmd = ["qvm-pass", "get", "--", name]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    out = p.communicate()[0]
+    if p.returncode == ABSENT:
+        return None
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return out.decode("utf-8").rstrip("\n")
+
+
+def insert(name, content):
+    cmd = ["qvm-pass", "insert", "-f", "-m", "--", name]
+    p = subprocess.Popen(cmd,
+                         stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    out = p.communicate(content.encode("utf-8"))[0].strip()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd, out)
+
+
+def wanted_entries(args):
+    '''Return the entries args asks for, as an ordered mapping of name to contents.'''
+    entries = args.get("entries")
+    if entries is None:
+        entries = [dict(name=args["name"], content=args["content"])]
+    elif isinstance(entries, dict):
+        entries = [dict(name=k, content=v) for k, v in entries.items()]
+    wanted = collections.OrderedDict()
+    for entry in entries:
+        content = entry.get("content")
+        # Numbers and booleans are written as YAML gives them; anything
+        # else but text is most likely a mistake.
+        if isinstance(content, (bool, int, float)):
+            content = to_text(content)
+        if not isinstance(content, str):
+            if content is None:
+                kind = "nothing"
+            elif isinstance(content, collections.abc.Mapping):
+                kind = "a dictionary"
+            elif isinstance(content, collections.abc.Sequence):
+                kind = "a list"
+            else:
+                kind = type(content).__name__
+            raise AnsibleActionFail("the content of password entry %s must be text, not %s" % (
+                entry.get("name"), kind,
+            ))
+        wanted[entry["name"]] = content.rstrip("\n")
+    return wanted
+
+
+def sync(wanted, parallelism, check_mode=False):
+    '''Make the entries in wanted have their contents.
+
+    Every entry is read first, parallelism of them at a time, since
+    each read is a qrexec call of its own into the vault, and then
+    only the entries that differ are written, one after the other,
+    since pass commits every one of them to its git repository.
+    Returns the entries created, those updated, and how many qrexec
+    calls of each kind were made.
+    '''
+    with ThreadPoolExecutor(max_workers=parallelism) as pool:
+        snapshot = dict(zip(wanted, pool.map(get, wanted)))
+    created, updated = [], []
+    for name, content in wanted.items():
+        if snapshot[name] == content:
+            continue
+        if not check_mode:
+            insert(name, content)
+        (created if snapshot[name] is None else updated).append(name)
+    calls = dict(get=len(wanted), insert=0 if check_mode else len(created) + len(updated))
+    return created, updated, calls
 
 
 class ActionModule(ActionBase):
@@ -10,47 +92,43 @@ class ActionModule(ActionBase):
     def __init__(self, *args, **kw):
         ActionBase.__init__(self, *args, **kw)
 
-    def run(self, task_vars=None):
+    def run(self, tmp=None, task_vars=None):
         ''' handler for launcher operations '''
         if task_vars is None:
             task_vars = dict()
 
-        name = self._task.args["name"]
-        if self._task.args["state"] == "present":
-            return self.present(self._task.args["name"], self._task.args["content"])
-
-    def present(self, name, content):
-        result = {"changed": False}
+        parallelism = int(self._task.args.get("parallelism", 8))
+        if parallelism < 1:
+            return {"failed": True, "msg": "parallelism must be at least 1"}
+        state = self._task.args.get("state", "present")
+        if state == "present":
+            return self.present(wanted_entries(self._task.args), parallelism)
+        return {"failed": True, "msg": "unsupported state %s" % state}
 
-        content = content.rstrip("\n")
-
-        present = False
+    def present(self, wanted, parallelism):
+        start = time.time()
         try:
-            oldcontent = subprocess.check_output(
-                ["qvm-pass", "get", "--", name],
-                stderr=file(os.devnull, "a")).rstrip("\n")
-            if oldcontent == content:
-                present = True
+            created, updated, calls = sync(wanted, parallelism, self._play_context.check_mode)
         except subprocess.CalledProcessError as e:
-            if e.returncode != 8:
-                raise
-            # Else do nothing, the content is absent, we continue.
-
-        if not present:
-            if not self._play_context.check_mode:
-                cmd = ["qvm-pass", "insert", "-f", "-m", "--", name]
-                p = subprocess.Popen(cmd,
-                                     stdin=subprocess.PIPE,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
-                out = p.communicate(content)[0].strip()
-                ret = p.wait()
-                if ret != 0:
-                    raise subprocess.CalledProcessError(ret, cmd, out)
-            result["changed"] = True
-            if present:
-                result["msg"] = "Password entry %s updated." % (name,)
-            else:
-                result["msg"] = "Password entry %s created." % (name,)
-
+            return {"failed": True, "msg": "qvm-pass failed: %s" % (e,)}
+        if (created or updated) and not self._play_context.check_mode:
+            # Lookups of these entries later in the run must not see the old contents.
+            lookup = self._shared_loader_obj.lookup_loader.get("qubes-pass", loader=self._loader, templar=self._templar)
+            if lookup is not None:
+                lookup.invalidate(created + updated)
+        result = {
+            "changed": bool(created or updated),
+            "created": created,
+            "updated": updated,
+            "calls": calls,
+            "elapsed": round(time.time() - start, 3),
+        }
+        if len(wanted) == 1 and created:
+            result["msg"] = "Password entry %s created." % (created[0],)
+        elif len(wanted) == 1 and updated:
+            result["msg"] = "Password entry %s updated." % (updated[0],)
+        elif len(wanted) > 1:
+            result["msg"] = "%d password entries created, %d updated, %d unchanged." % (
+                len(created), len(updated), len(wanted) - len(created) - len(updated),
+            )
         return result
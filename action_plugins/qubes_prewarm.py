@@ -0,0 +1,123 @@
+from ansible.plugins.action import ActionBase
+import json
+import os
+import selectors
+import time
+
+
+def _warm(connection):
+    '''Connect, which starts the VM if it is halted, and report how long that took.'''
+    start = time.time()
+    connection._connect()
+    ready = time.time() - start
+    connection.close()
+    return ready
+
+
+def _fork_warm(connection):
+    '''Warm connection up in a child process, returning its PID and the pipe it reports on.
+
+    Children, rather than threads, do the work, because connecting
+    may fork a shared session daemon, which is not safe to do from
+    a process with other threads running.
+    '''
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            try:
+                report = {"ready": _warm(connection)}
+            except Exception as e:
+                report = {"failed": "%s" % (e,)}
+            with os.fdopen(w, "wb") as f:
+                f.write(json.dumps(report).encode("utf-8"))
+        finally:
+            os._exit(0)
+    os.close(w)
+    return pid, r
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
+
+    def __init__(self, *args, **kw):
+        ActionBase.__init__(self, *args, **kw)
+
+    def run(self, tmp=None, task_vars=None):
+        ''' handler for pre-warming Qubes VMs '''
+        if task_vars is None:
+            task_vars = dict()
+
+        hosts = self._task.args.get("hosts", task_vars.get("ansible_play_hosts", []))
+        try:
+            parallelism = int(self._task.args.get("parallelism", 8))
+        except (TypeError, ValueError):
+            return {"failed": True, "msg": "parallelism must be a number, not %r" % (self._task.args.get("parallelism"),)}
+        if parallelism < 1:
+            return {"failed": True, "msg": "parallelism must be at least 1"}
+
+        connections = []
+        for host in hosts:
+            variables = task_vars["hostvars"][host]
+            templar = self._templar.copy_with_new_env(available_variables=variables)
+            if templar.template(variables.get("ansible_connection", self._play_context.connection)) != "qubes":
+                continue
+            connections.append((host, self.connection_for(host, variables, templar)))
+
+        result = {"changed": False, "ready": {}, "failures": {}}
+        start = time.time()
+        pending = list(connections)
+        running = selectors.DefaultSelector()
+        while pending or running.get_map():
+            while pending and len(running.get_map()) < parallelism:
+                host, connection = pending.pop(0)
+                pid, r = _fork_warm(connection)
+                running.register(r, selectors.EVENT_READ, (host, pid, []))
+            # Reports are read as they come, so that no child blocks
+            # writing its own, and only children of ours are reaped,
+            # once they closed their pipe.
+            key, _ = running.select()[0]
+            host, pid, chunks = key.data
+            data = os.read(key.fd, 65536)
+            if data:
+                chunks.append(data)
+                continue
+            running.unregister(key.fd)
+            os.close(key.fd)
+            os.waitpid(pid, 0)
+            report = b"".join(chunks)
+            try:
+                report = json.loads(report.decode("utf-8"))
+            except ValueError:
+                report = {"failed": "the pre-warm of %s died unexpectedly" % (host,)}
+            if "ready" in report:
+                result["ready"][host] = round(report["ready"], 3)
+            else:
+                result["failures"][host] = report["failed"]
+        running.close()
+        result["elapsed"] = round(time.time() - start, 3)
+
+        if result["failures"]:
+            result["warnings"] = [
+                "could not pre-warm %s: %s" % (host, msg)
+                for host, msg in sorted(result["failures"].items())
+            ]
+        result["msg"] = "%s of %s VMs ready in %.1f seconds" % (
+            len(result["ready"]), len(connections), result["elapsed"],
+        )
+        return result
+
+    def connection_for(self, host, variables, templar):
+        '''Return a qubes connection to host, set up like its tasks would get.
+
+        templar templates with the variables of host.
+        '''
+        play_context = self._play_context.copy()
+        play_context.remote_addr = templar.template(variables.get("ansible_host", host))
+        connection = self._shared_loader_obj.connection_loader.get("qubes", play_context, None)
+        resolve = getattr(connection, "_resolve_option_variables", None)
+        var_options = resolve(variables, templar) if resolve else variables
+        connection.set_options(var_options=var_options)
+        return connection
@@ -1,31 +1,72 @@
 import collections
+import hashlib
 import os
+import shutil
 import sys
 import tempfile
+import yaml
+from ansible import constants as C
 from ansible import errors
-from ansible.plugins.action.template import ActionModule as template
+from ansible.module_utils.common.text.converters import to_bytes
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    from yaml import CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeDumper as Dumper
 
 sys.path.insert(0, os.path.dirname(__file__))
 import commonlib
 
-contents = """{{ vms | to_nice_yaml }}"""
-topcontents = "{{ saltenv }}:\n  '*':\n  - {{ recipename }}\n"
+topcontents = "%s:\n  '*':\n  - %s\n"
+
+# Options of the template module that make no sense without a template.
+TEMPLATE_ONLY = ('newline_sequence', 'block_start_string', 'block_end_string', 'variable_start_string', 'variable_end_string',
+                 'comment_start_string', 'comment_end_string', 'trim_blocks', 'lstrip_blocks', 'output_encoding')
+
+
+def plain(data):
+    '''Return data as the plain Python types that the safe YAML dumper knows.'''
+    if isinstance(data, dict):
+        return dict((plain(k), plain(v)) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return [plain(v) for v in data]
+    if isinstance(data, str):
+        return str(data)
+    if isinstance(data, bool):
+        return bool(data)
+    if isinstance(data, int):
+        return int(data)
+    if isinstance(data, float):
+        return float(data)
+    return data
+
+
+def render(vms):
+    '''Return the recipe for vms, as to_nice_yaml would have it.'''
+    return yaml.dump(plain(vms), Dumper=Dumper, indent=4, allow_unicode=True, default_flow_style=False)
 
 def generate_datastructure(vms, task_vars):
     dc = collections.OrderedDict
     d = dc()
+    # This set will skip any VMs that are not in the groups defined in the 'formation_vm_groups' variable
+    # This allows you to deploy in multiple stages which is useful in cases
+    # where you want to create a template after another template is already provisioned.
+    wanted = None
+    if 'formation_vm_groups' in task_vars:
+        wanted = set()
+        for group in task_vars['formation_vm_groups']:
+            wanted.update(task_vars['groups'][group])
     for n, data in vms.items():
-        # This block will skip any VMs that are not in the groups defined in the 'formation_vm_groups' variable
-        # This allows you to deploy in multiple stages which is useful in cases
-        # where you want to create a template after another template is already provisioned.
-        if 'formation_vm_groups' in task_vars:
-            continueLoop = True
-            for group in task_vars['formation_vm_groups']:
-                if n in task_vars['hostvars'][n]['groups'][group]:
-                    continueLoop = False
-            if continueLoop:
-                continue
-        
+        if wanted is not None and n not in wanted:
+            continue
+
         qubes = data['qubes']
         d[task_vars['hostvars'][n]['inventory_hostname_short']] = dc(qvm=['vm'])
         vm = d[task_vars['hostvars'][n]['inventory_hostname_short']]
@@ -99,49 +140,282 @@ def generate_datastructure(vms, task_vars):
 
     return d
 
-class ActionModule(template):
+
+def requirements(vm):
+    '''Return the names of the VMs that the recipe of vm requires.'''
+    for item in vm['qvm']:
+        if isinstance(item, dict) and 'require' in item:
+            return [r['qvm'] for r in item['require']]
+    return []
+
+
+def formation_waves(d):
+    '''Split the VMs of the formation d into waves, in dependency order.
+
+    Every VM comes in the wave after the last of the VMs it requires,
+    so the VMs of a wave do not depend on one another, and can be
+    created all at the same time.  Requirements on VMs that are not
+    part of the formation are taken to be there already.  Raises an
+    error if VMs depend on one another in a cycle.
+    '''
+    deps = collections.OrderedDict(
+        (n, set(r for r in requirements(vm) if r in d and r != n))
+        for n, vm in d.items()
+    )
+    for n, vm in d.items():
+        if n in requirements(vm):
+            raise errors.AnsibleError("VM %s requires itself" % (n,))
+    dependents = dict((n, []) for n in deps)
+    for n, required in deps.items():
+        for r in required:
+            dependents[r].append(n)
+    pending = dict((n, len(required)) for n, required in deps.items())
+    waves = []
+    wave = [n for n in deps if not pending[n]]
+    while wave:
+        waves.append(wave)
+        following = set()
+        for n in wave:
+            del pending[n]
+            for m in dependents[n]:
+                pending[m] = pending[m] - 1
+                if not pending[m]:
+                    following.add(m)
+        wave = [n for n in pending if n in following]
+    if pending:
+        # Walk back from any VM left over until a VM comes up twice.
+        path, n = [], next(iter(pending))
+        while n not in path:
+            path.append(n)
+            n = next(r for r in deps[n] if r in pending)
+        cycle = path[path.index(n):] + [n]
+        raise errors.AnsibleError("VMs require one another in a cycle: %s" % (" -> ".join(cycle),))
+    return waves
+
+
+# Names qvm-ls knows the properties by, where the qubes attribute
+# calls them differently.
+PROPERTY_COLUMNS = {'mem': 'MEMORY'}
+
+
+def property_column(name):
+    return PROPERTY_COLUMNS.get(name, name.upper().replace('-', '_'))
+
+
+def pref_value(value):
+    '''Return value as qvm-ls --raw-data would show it, to compare them.'''
+    if value is None or value == '-':
+        return ''
+    return '%s' % (value,)
+
+
+def prune_formation(d, current):
+    '''Leave out of the formation d what the VMs in current have already.
+
+    current holds what qvm-ls says of every VM, by VM name and
+    column.  Preferences that have the wanted value are left out, as
+    are starting running VMs, and VMs left with nothing to do but
+    exist.  Services cannot be checked here, so they stay.  Returns
+    the pruned formation, how many VMs and how many preferences were
+    left out.
+    '''
+    pruned = collections.OrderedDict()
+    gone = set()
+    prefs_pruned = 0
+    for n, vm in d.items():
+        state = current.get(n)
+        if state is None:
+            pruned[n] = vm
+            continue
+        qvm = []
+        for item in vm['qvm']:
+            if isinstance(item, dict) and 'prefs' in item:
+                stale = [
+                    p for p in item['prefs']
+                    if any(pref_value(v) != state.get(property_column(k)) for k, v in p.items())
+                ]
+                prefs_pruned = prefs_pruned + len(item['prefs']) - len(stale)
+                if not stale:
+                    continue
+                item = {'prefs': stale}
+            elif isinstance(item, dict) and 'start' in item:
+                if state.get('STATE') == 'running':
+                    continue
+            qvm.append(item)
+        kept = set(k for item in qvm if isinstance(item, dict) for k in item)
+        actions = [a for a in qvm[1]['actions'] if a in kept]
+        if not [a for a in actions if a not in ('present', 'clone', 'exists')]:
+            gone.add(n)
+            continue
+        qvm[1] = collections.OrderedDict(actions=actions)
+        pruned[n] = collections.OrderedDict(qvm=qvm)
+    # What the VMs left out are required for, they are there already.
+    for n, vm in pruned.items():
+        qvm = []
+        for item in vm['qvm']:
+            if isinstance(item, dict) and 'require' in item:
+                require = [r for r in item['require'] if r['qvm'] not in gone]
+                if not require:
+                    continue
+                item = {'require': require}
+            qvm.append(item)
+        vm['qvm'] = qvm
+    return pruned, len(gone), prefs_pruned
+
+
+def wave_datastructure(d, wave, parallel):
+    '''Return the recipe for the VMs of wave only, free of requirements.
+
+    What the VMs of a wave require comes in earlier waves, which are
+    realized by then, so the requirements are left out.  With parallel,
+    Salt creates the VMs of the wave concurrently.
+    '''
+    dc = collections.OrderedDict
+    w = dc()
+    for n in wave:
+        qvm = [item for item in d[n]['qvm'] if not (isinstance(item, dict) and 'require' in item)]
+        if parallel:
+            qvm.append({'parallel': True})
+        w[n] = dc(qvm=qvm)
+    return w
+
+
+class ActionModule(ActionBase):
 
     TRANSFERS_FILES = True
 
     def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+        super(ActionModule, self).run(tmp, task_vars)
+
+        args = dict(self._task.args)
+        try:
+            split = boolean(args.pop('waves', False))
+            prune = boolean(args.pop('prune', False))
+            parallel = boolean(args.pop('parallel', True))
+        except TypeError as e:
+            raise errors.AnsibleActionFail("%s" % (e,))
+        dest = args.pop('dest')
+        for x in TEMPLATE_ONLY + ('src', 'content'):
+            args.pop(x, None)
+
         qubesdata = commonlib.inject_qubes(task_vars)
-        task_vars["vms"] = generate_datastructure(qubesdata, task_vars)
-        with tempfile.NamedTemporaryFile() as x:
-            x.write(contents.encode())
-            x.flush()
-            self._task.args['src'] = x.name
-            retval = template.run(self, tmp, task_vars)
+        vms = generate_datastructure(qubesdata, task_vars)
+        pruned = None
+        if prune:
+            current = self.current_state(vms)
+            if current is not None:
+                vms, pruned_vms, pruned_prefs = prune_formation(vms, current)
+                pruned = dict(vms=pruned_vms, prefs=pruned_prefs)
+        # Cycles are found before anything is written.
+        waves = formation_waves(vms)
+
+        # Both documents, and those of the waves, are rendered here in
+        # one go, rather than through the template action.
+        namenoext = os.path.splitext(dest)[0]
+        saltenv = "user" if "user_salt" in dest.split(os.sep) else "base"
+        documents = collections.OrderedDict()
+        documents[dest] = render(vms)
+        documents[namenoext + ".top"] = topcontents % (saltenv, os.path.basename(namenoext))
+        wave_sls = []
+        if split:
+            for number, wave in enumerate(waves, 1):
+                path = "%s-wave-%d.sls" % (namenoext, number)
+                documents[path] = render(wave_datastructure(vms, wave, parallel))
+                wave_sls.append(os.path.basename(os.path.splitext(path)[0]))
+
+        # Files whose contents are already right are left alone, unless
+        # there are attributes like the mode to enforce on them too.
+        stale = list(documents) if args else self.stale(documents)
+        changed = []
+        for path in stale:
+            retval = self.copy(path, documents[path], args, task_vars)
             if retval.get("failed"):
                 return retval
-    
-            with tempfile.NamedTemporaryFile() as y:
-                y.write(topcontents.encode())
-                y.flush()
-
-                # Create new tmp path -- the other was blown away.
-                tmp = self._make_tmp_path()
-
-                self._task.args["src"] = y.name
-                namenoext = os.path.splitext(self._task.args["dest"])[0]
-                dest = namenoext + ".top"
-                self._task.args["dest"] = dest
-                task_vars["recipename"] = os.path.basename(namenoext)
-                task_vars["saltenv"] = "user" if "user_salt" in dest.split(os.sep) else "base"
-                retval2 = template.run(self, tmp, task_vars)
-                if retval2.get("failed"):
-                    return retval2
-
-            if not retval['changed'] and not retval2['changed']:
-                for c in ('path', 'size'):
-                    retval[c] = [x[c] for x in (retval, retval2) if c in x]
-                return retval
-            elif retval['changed'] and retval2['changed']:
-                for c in ('src', 'checksum', 'size', 'state', 'changed', 'md5sum', 'dest'):
-                    retval[c] = [x[c] for x in (retval, retval2) if c in x]
-                return retval
-            elif retval['changed']:
-                return retval
-            elif retval2['changed']:
-                return retval2
-            else:
-                assert 0, "not reached"
+            if retval.get("changed"):
+                changed.append(path)
+
+        result = dict(changed=bool(changed), dest=list(documents), changed_files=changed, waves=waves)
+        if split:
+            result["wave_sls"] = wave_sls
+        if pruned is not None:
+            result["pruned"] = pruned
+        elif prune:
+            result["warnings"] = ["could not read the properties of the VMs with qvm-ls, so nothing was pruned"]
+        return result
+
+    def current_state(self, d):
+        '''Return what qvm-ls says of every VM, by VM name and column.
+
+        All of the properties the formation sets are read with one
+        qvm-ls command.  If qvm-ls has no column for some of them, it
+        is asked which columns it has, and the others are read; those
+        it has no column for are left out.  Returns None if qvm-ls
+        cannot tell even that.
+        '''
+        columns = ['NAME', 'STATE']
+        for vm in d.values():
+            for item in vm['qvm']:
+                if isinstance(item, dict) and 'prefs' in item:
+                    for p in item['prefs']:
+                        for k in p:
+                            if property_column(k) not in columns:
+                                columns.append(property_column(k))
+        res = self._low_level_execute_command("qvm-ls --raw-data --fields %s" % (quote(",".join(columns)),))
+        if res.get("rc") != 0:
+            res = self._low_level_execute_command("qvm-ls --help-columns")
+            if res.get("rc") != 0:
+                return None
+            known = set(line.split()[0] for line in res.get("stdout", "").splitlines() if line.split())
+            columns = [c for c in columns if c in known or c in ('NAME', 'STATE')]
+            res = self._low_level_execute_command("qvm-ls --raw-data --fields %s" % (quote(",".join(columns)),))
+            if res.get("rc") != 0:
+                return None
+        current = dict()
+        for line in res.get("stdout", "").splitlines():
+            values = line.split("|")
+            if len(values) != len(columns):
+                return None
+            current[values[0]] = dict(zip(columns, (pref_value(v) for v in values)))
+        return current
+
+    def stale(self, documents):
+        '''Return the paths among documents whose files differ from their contents.
+
+        The SHA-256 of all of the files is taken in one command.
+        '''
+        cmd = "sha256sum -- %s 2>/dev/null ; true" % " ".join(quote(p) for p in documents)
+        res = self._low_level_execute_command(cmd)
+        current = dict()
+        for line in res.get("stdout", "").splitlines():
+            digest, _, path = line.partition("  ")
+            current[path] = digest
+        return [
+            path for path, content in documents.items()
+            if current.get(path) != hashlib.sha256(to_bytes(content)).hexdigest()
+        ]
+
+    def copy(self, path, content, args, task_vars):
+        '''Put content into path on the target, with the copy action.'''
+        local_tempdir = tempfile.mkdtemp(dir=C.DEFAULT_LOCAL_TMP)
+        try:
+            src = os.path.join(local_tempdir, os.path.basename(path))
+            with open(src, "wb") as f:
+                f.write(to_bytes(content))
+            new_task = self._task.copy()
+            new_task.args.clear()
+            new_task.args.update(args)
+            new_task.args.update(dict(src=src, dest=path))
+            copy_action = self._shared_loader_obj.action_loader.get(
+                'ansible.legacy.copy',
+                task=new_task,
+                connection=self._connection,
+                play_context=self._play_context,
+                loader=self._loader,
+                templar=self._templar,
+                shared_loader_obj=self._shared_loader_obj,
+            )
+            return copy_action.run(task_vars=task_vars)
+        finally:
+            shutil.rmtree(local_tempdir)
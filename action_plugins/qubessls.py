@@ -1,21 +1,180 @@
-import pipes
+import collections
+import re
 from ansible import errors
-from ansible.plugins.action.command import ActionModule as command
+from ansible.module_utils.common.text.converters import to_bytes, to_text
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from ansible.utils.display import Display
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
-class ActionModule(command):
+display = Display()
+
+SALT_ROOTS = dict(base="/srv/salt", user="/srv/user_salt")
+
+# Where the last successful realization of every recipe is recorded.
+RECORDS = "/var/lib/qubes/ansible-qubessls"
+
+# What qubesctl says of every VM it is done with.
+VM_DONE = re.compile(r"^(\S+): (OK|ERROR.*)$")
+
+
+def qubesctl_command(args):
+    '''Return the qubesctl command that realizes the recipe args name.'''
+    cmd = ["qubesctl"]
+    if boolean(args.get('skip_dom0', False)):
+        cmd.append("--skip-dom0")
+    targets = args.get('targets')
+    if targets:
+        if not isinstance(targets, str):
+            targets = ",".join(targets)
+        cmd.append("--targets=%s" % (targets,))
+    if args.get('max_concurrency'):
+        cmd.append("--max-concurrency=%d" % (int(args['max_concurrency']),))
+    cmd.append('state.sls')
+    cmd.append(args['sls'])
+    if 'env' in args:
+        cmd.append("saltenv=%s" % (args['env'],))
+    return cmd
+
+
+class Progress(object):
+    '''Split output into lines, reporting every VM qubesctl is done with.'''
+
+    def __init__(self, report):
+        self.report = report
+        self.partial = b""
+        self.vms = collections.OrderedDict()
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line)
+
+    def line(self, line):
+        m = VM_DONE.match(to_text(line, errors="surrogate_or_replace").rstrip())
+        if m:
+            self.vms[m.group(1)] = m.group(2)
+            self.report(m.group(1), m.group(2))
+
+    def finish(self):
+        if self.partial:
+            self.line(self.partial)
+            self.partial = b""
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = False
 
     def run(self, tmp=None, task_vars=None):
-        cmd = ["qubesctl"]
-        cmd.append('state.sls')
-        cmd.append(self._task.args['sls'])
-        if 'env' in self._task.args:
-            cmd.append("saltenv=%s" % (self._task.args['env'],))
-        module_args = " ".join(pipes.quote(s) for s in cmd)
-        module_args = "bash -c %s" % pipes.quote("DISPLAY=:0 " + module_args)
-        self._task.action = "command"
-        self._task.args['_raw_params'] = module_args
-        for x in 'env sls'.split():
-            if x in self._task.args:
-                del self._task.args[x]
-        return command.run(self, tmp, task_vars)
+        if task_vars is None:
+            task_vars = dict()
+        super(ActionModule, self).run(tmp, task_vars)
+
+        args = self._task.args
+        if 'sls' not in args:
+            raise errors.AnsibleActionFail("sls is required")
+        try:
+            cmd = " ".join(quote(s) for s in qubesctl_command(args))
+            skip_unchanged = boolean(args.get('skip_unchanged', False))
+        except TypeError as e:
+            raise errors.AnsibleActionFail("%s" % (e,))
+        cmd = "DISPLAY=:0 " + cmd
+
+        # The recipe is not realized again if neither it nor the way
+        # to realize it changed since the last time it succeeded.
+        record = None
+        if skip_unchanged:
+            record = self.record(args, cmd)
+            if record is None:
+                return dict(changed=False, skipped=True, cmd=cmd,
+                            msg="%s is unchanged since it was last realized" % (args['sls'],))
+
+        # Neither qubesctl nor the record of its realization may run
+        # in check mode, as the command action would not have run it.
+        if self._play_context.check_mode:
+            return dict(changed=True, cmd=cmd,
+                        msg="%s would be realized, but not in check mode" % (args['sls'],))
+
+        host = self._play_context.remote_addr
+        progress = Progress(lambda vm, status: display.display("%s: %s: %s" % (host, vm, status)))
+        rc, stdout, stderr = self.realize("bash -c %s" % (quote(cmd),), progress)
+        progress.finish()
+
+        result = dict(
+            changed=True,
+            cmd=cmd,
+            rc=rc,
+            stdout=stdout,
+            stderr=stderr,
+            stdout_lines=stdout.splitlines(),
+            stderr_lines=stderr.splitlines(),
+            vms=dict(progress.vms),
+        )
+        failed = [vm for vm, status in progress.vms.items() if status != "OK"]
+        if rc != 0:
+            result["failed"] = True
+            result["msg"] = "non-zero return code"
+        elif failed:
+            result["failed"] = True
+            result["msg"] = "could not realize %s in %s" % (args['sls'], ", ".join(failed))
+        elif record is not None:
+            digest, path = record
+            res = self._low_level_execute_command("mkdir -p %s && printf '%%s\\n' %s > %s" % (
+                quote(RECORDS), quote(digest), quote(path),
+            ))
+            if res.get("rc") != 0:
+                result["warnings"] = ["could not record the realization of %s: %s" % (args['sls'], res.get("stderr", ""))]
+        return result
+
+    def record(self, args, cmd):
+        '''Return what to record of a realization of the recipe, and where.
+
+        Returns None when the recipe, and the command to realize it,
+        are those of the last successful realization.  Both are read in
+        one command.  Only the SLS file itself counts, not those it
+        includes, and it must exist.
+        '''
+        root = SALT_ROOTS.get(args.get('env', 'base'), SALT_ROOTS['base'])
+        base = "%s/%s" % (root, args['sls'].replace(".", "/"))
+        path = "%s/%s-%s" % (RECORDS, args.get('env', 'base'), args['sls'])
+        res = self._low_level_execute_command(
+            "for f in %s %s ; do if [ -f \"$f\" ] ; then sha256sum < \"$f\" && cat -- %s 2>/dev/null ; exit 0 ; fi ; done ;"
+            " echo %s >&2 ; exit 1" % (
+                quote(base + ".sls"), quote(base + "/init.sls"), quote(path),
+                quote("neither %s.sls nor %s/init.sls exists" % (base, base)),
+            )
+        )
+        lines = res.get("stdout", "").splitlines()
+        if res.get("rc") != 0 or not lines:
+            raise errors.AnsibleActionFail("could not hash the recipe %s: %s" % (args['sls'], res.get("stderr", "")))
+        digest = "%s %s" % (lines[0].split()[0], cmd)
+        if lines[1:] == [digest]:
+            return None
+        return digest, path
+
+    def realize(self, cmd, progress):
+        '''Run cmd, feeding its output to progress, and return its exit code and output.
+
+        Connections that can hand output over as it comes, like that
+        of the Qubes connection plugin, let progress report each VM as
+        soon as it is done.  With other connections, or when becoming
+        another user, the VMs are reported when qubesctl is done.
+        '''
+        streaming = getattr(self._connection, "exec_command_streaming", None)
+        if streaming is None or self._play_context.become:
+            res = self._low_level_execute_command(cmd)
+            progress.feed(to_bytes(res.get("stdout", "")))
+            return res.get("rc", 1), res.get("stdout", ""), res.get("stderr", "")
+        stdout, stderr = [], []
+
+        def out(data):
+            stdout.append(data)
+            progress.feed(data)
+        rc = streaming(cmd, out, stderr.append)
+        return rc, to_text(b"".join(stdout)), to_text(b"".join(stderr))
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+"""Throughput and CPU use of bombshell-client with each of its engines.
+
+bombshell-client runs against fakebin/qrexec-client-vm, which runs the
+remote end on the local machine, so both ends of the link are measured.
+The CPU time counts both bombshell-client processes and the command
+they run, which is the same for every engine.  "small writes" sends a
+sixteenth of the data, written 512 bytes at a time, which the event
+loop coalesces into bigger frames while the link is busy.
+
+The startup figures time a command that does nothing, run over a link
+of its own and through a session daemon that keeps the link open.
+"""
+
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+bombshell = os.path.join(here, os.path.pardir, "bin", "bombshell-client")
+CHUNK = 1024 * 1024
+
+SMALL_WRITES = "import os\nfor _ in range({size} // 512): os.write(1, bytes(512))"
+DIRECTIONS = (
+    ("upload", ["sh", "-c", "cat > /dev/null"], True, False, 1),
+    ("download", ["head", "-c", "{size}", "/dev/zero"], False, True, 1),
+    ("both ways", ["cat"], True, True, 1),
+    ("small writes", ["python3", "-c", SMALL_WRITES], False, True, 16),
+)
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(engine, cmd, send, receive, size):
+    env = dict(os.environ, BOMBSHELL_ENGINE=engine)
+    env["PATH"] = os.path.join(here, "fakebin") + os.pathsep + env["PATH"]
+    cmd = [x.format(size=size) for x in cmd]
+    cpu, start = children_cpu(), time.perf_counter()
+    p = subprocess.Popen(
+        [bombshell, "fakevm"] + cmd, env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    received = []
+
+    def drain():
+        total = 0
+        while True:
+            data = p.stdout.read1(CHUNK)
+            if not data:
+                break
+            total = total + len(data)
+        received.append(total)
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+    if send:
+        block = b"\0" * CHUNK
+        for _ in range(size // CHUNK):
+            p.stdin.write(block)
+    p.stdin.close()
+    reader.join()
+    assert p.wait() == 0
+    elapsed = time.perf_counter() - start
+    assert received[0] == (size if receive else 0), received
+    gigabytes = size / 1024.0 ** 3 * (2 if send and receive else 1)
+    return size / elapsed / 1024 / 1024, (children_cpu() - cpu) / gigabytes
+
+
+def measure_startup(persist, runs=30):
+    env = dict(os.environ, BOMBSHELL_CONTROL_PERSIST="%d" % persist)
+    env["PATH"] = os.path.join(here, "fakebin") + os.pathsep + env["PATH"]
+    times = []
+    with tempfile.TemporaryDirectory() as control_path_dir:
+        env["BOMBSHELL_CONTROL_PATH_DIR"] = control_path_dir
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.check_call([bombshell, "fakevm", "true"], env=env)
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000, times[0] * 1000
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024 * 1024 * 1024
+    print("%-12s  %-8s  %10s  %10s" % ("direction", "engine", "MB/s", "CPU s/GB"))
+    for name, cmd, send, receive, scale in DIRECTIONS:
+        for engine in "threads", "loop":
+            rate, cpu = measure(engine, cmd, send, receive, size // scale)
+            print("%-12s  %-8s  %10.1f  %10.2f" % (name, engine, rate, cpu))
+    print()
+    print("%-12s  %10s  %10s" % ("startup", "median ms", "min ms"))
+    for name, persist in ("own link", 0), ("session", 5):
+        print("%-12s  %10.1f  %10.1f" % ((name,) + measure_startup(persist)))
+
+
+if __name__ == "__main__":
+    main()
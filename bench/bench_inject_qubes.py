@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+"""Time and memory commonlib.inject_qubes takes over large inventories.
+
+Builds synthetic inventories of VMs spread over ten dom0s, where every
+host has, besides its qubes attribute, a few dozen variables of the
+kind group_vars bring along, and runs inject_qubes for every dom0, as
+the qubesformation and qubesguid actions do.  Every call walks the
+whole inventory, as the action for each dom0 runs in a worker process
+of its own; the second figure is what one such action takes.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir, "action_plugins"))
+import commonlib  # noqa
+
+DOM0S = 10
+
+
+def inventory(vms):
+    dom0s = ["dom0-%d" % n for n in range(DOM0S)]
+    hostvars = dict()
+    for dom0 in dom0s:
+        hostvars[dom0] = {"ansible_connection": "local"}
+    for n in range(vms):
+        name = "vm-%d" % n
+        dom0 = dom0s[n % DOM0S]
+        qubes = {
+            "dom0_vm": dom0,
+            "label": "red",
+            "services": {"cups": False, "crond": True, "meminfo-writer": "default"},
+        }
+        if n < DOM0S * 2:
+            qubes["vm_type"] = "TemplateVM" if n < DOM0S else "NetVM"
+        else:
+            qubes["vm_type"] = "AppVM"
+            qubes["template_vm"] = "sibling(vm-%d)" % (n % DOM0S)
+            qubes["netvm_vm"] = "vm-%d" % (DOM0S + n % DOM0S)
+        hostvars[name] = dict(
+            ("var_%d" % v, ["item %d" % i for i in range(5)]) for v in range(40)
+        )
+        hostvars[name]["qubes"] = qubes
+    return {
+        "groups": {"all": list(hostvars)},
+        "hostvars": hostvars,
+    }, dom0s
+
+
+def one_pass(inject, dom0s):
+    for dom0 in dom0s:
+        inject["inventory_hostname"] = dom0
+        commonlib.inject_qubes(inject)
+
+
+def measure(vms):
+    inject, dom0s = inventory(vms)
+    tracemalloc.start()
+    start = time.perf_counter()
+    one_pass(inject, dom0s)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return total, total / len(dom0s), peak
+
+
+def main():
+    print("%8s  %14s  %14s  %12s" % ("VMs", "total (ms)", "per dom0 (ms)", "peak (MiB)"))
+    for vms in (100, 1000, 10000):
+        total, per_dom0, peak = measure(vms)
+        print("%8d  %14.1f  %14.1f  %12.1f" % (vms, total * 1000, per_dom0 * 1000, peak / 1024.0 / 1024.0))
+
+
+if __name__ == "__main__":
+    main()
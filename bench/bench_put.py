@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+"""Upload throughput of put_file with the text and the binary protocol.
+
+The text protocol waits for the VM to acknowledge every chunk before
+sending the next one, while the binary protocol keeps a window of
+chunks in flight.  To show what that means over a real link, the
+uploads also go through latency-transport, which adds a delay to
+every byte.  Needs Ansible installed.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, os.path.pardir, "connection_plugins"))
+import qubes  # noqa
+
+
+class PlayContext(object):
+    shell = 'sh'
+    executable = 'sh'
+    become = False
+    become_method = 'sudo'
+    remote_addr = 'localhost'
+
+
+def connection(protocol, latency):
+    if latency:
+        transport_cmd = [os.path.join(here, "latency-transport"), "%s" % latency]
+    else:
+        transport_cmd = ['sh', '-c', '"$@"']
+    c = qubes.Connection(PlayContext(), None, transport_cmd=transport_cmd)
+    c._options = {
+        "management_proxy": None,
+        "control_persist": 0,
+        "control_path_dir": None,
+        "rpc_protocol": protocol,
+    }
+    return c
+
+
+def measure(protocol, latency, path, size):
+    c = connection(protocol, latency)
+    try:
+        c.exec_command(["true"])
+        with tempfile.NamedTemporaryFile() as dest:
+            start = time.perf_counter()
+            c.put_file(path, dest.name)
+            # The text protocol does not wait for the VM to finish
+            # writing, so wait for a command to run after the upload.
+            c.exec_command(["true"])
+            elapsed = time.perf_counter() - start
+            assert os.path.getsize(dest.name) == size
+        return size / elapsed / 1024 / 1024
+    finally:
+        c.close()
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 32 * 1024 * 1024
+    with tempfile.NamedTemporaryFile() as src:
+        src.write(os.urandom(size))
+        src.flush()
+        print("%12s  %12s  %14s  %8s" % ("latency (ms)", "text (MB/s)", "binary (MB/s)", "speedup"))
+        for latency in (0, 1, 5):
+            text = measure("text", latency, src.name, size)
+            binary = measure("binary", latency, src.name, size)
+            print("%12s  %12.1f  %14.1f  %7.1fx" % (latency, text, binary, binary / text))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+"""Time the qubes_pass action writing many entries, one by one and at once.
+
+Runs the work of the qubes_pass action over the stand-in for qvm-pass in
+fakebin/, which waits as long as a qrexec call into the vault would
+take, the --latency, before every call.  The entries are written first
+into an empty store, then again unchanged, then again with a tenth of
+them changed; once with one action per entry, the way a loop over the
+entries runs it, and once with all of the entries given to one action.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, os.path.pardir, "action_plugins"))
+import qubes_pass  # noqa
+
+
+def one_by_one(wanted, parallelism):
+    created, updated, calls = [], [], dict(get=0, insert=0)
+    for name, content in wanted.items():
+        c, u, n = qubes_pass.sync({name: content}, 1)
+        created.extend(c)
+        updated.extend(u)
+        for k in calls:
+            calls[k] = calls[k] + n[k]
+    return created, updated, calls
+
+
+def at_once(wanted, parallelism):
+    return qubes_pass.sync(wanted, parallelism)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100, help="entries to write (default: %(default)s)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every qvm-pass call takes (default: %(default)s)")
+    parser.add_argument("--parallelism", type=int, default=8, help="entries read at the same time (default: %(default)s)")
+    args = parser.parse_args()
+
+    os.environ["PATH"] = os.path.join(here, "fakebin") + os.pathsep + os.environ["PATH"]
+    os.environ["QVM_PASS_LATENCY"] = "%s" % (args.latency,)
+    first = dict(("bench/entry-%d" % n, "secret %d" % n) for n in range(args.entries))
+    changed = dict(first)
+    for n in range(0, args.entries, 10):
+        changed["bench/entry-%d" % n] = "new secret %d" % n
+    print("%-12s  %-10s  %8s  %8s  %10s" % ("how", "run", "gets", "inserts", "seconds"))
+    for how, fn in (("one by one", one_by_one), ("at once", at_once)):
+        store = tempfile.mkdtemp(prefix="bench-")
+        os.environ["QVM_PASS_STORE"] = store
+        try:
+            for run, wanted in (("empty", first), ("unchanged", first), ("tenth", changed)):
+                start = time.perf_counter()
+                _, _, calls = fn(wanted, args.parallelism)
+                elapsed = time.perf_counter() - start
+                print("%-12s  %-10s  %8d  %8d  %10.2f" % (how, run, calls["get"], calls["insert"], elapsed))
+        finally:
+            shutil.rmtree(store)
+
+
+if __name__ == "__main__":
+    main()
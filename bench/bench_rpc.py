@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+"""Per-module latency of the text and binary RPC protocols.
+
+Runs `cat` through the Qubes connection plugin with payloads of
+various sizes, much like Ansible does when it pipelines a module,
+over a local `sh -c` stand-in for qrun.  Needs Ansible installed.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.path.pardir, "connection_plugins"))
+import qubes  # noqa
+
+
+class PlayContext(object):
+    shell = 'sh'
+    executable = 'sh'
+    become = False
+    become_method = 'sudo'
+    remote_addr = 'localhost'
+
+
+def connection(protocol):
+    c = qubes.Connection(PlayContext(), None, transport_cmd=['sh', '-c', '"$@"'])
+    c._options = {
+        "management_proxy": None,
+        "control_persist": 0,
+        "control_path_dir": None,
+        "rpc_protocol": protocol,
+    }
+    return c
+
+
+def measure(protocol, size, rounds):
+    # Ansible payloads are mostly base64, so use something alike.
+    in_data = (b"UEsDBBQAAAAIAAAAIQ+/" * (size // 20 + 1))[:size]
+    c = connection(protocol)
+    try:
+        c.exec_command(["true"])
+        start = time.perf_counter()
+        for _ in range(rounds):
+            retcode, stdout, _ = c.exec_command(["cat"], in_data=in_data)
+            assert retcode == 0 and len(stdout) == size
+        return (time.perf_counter() - start) / rounds
+    finally:
+        c.close()
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print("%10s  %12s  %12s  %8s" % ("in_data", "text (ms)", "binary (ms)", "speedup"))
+    for size in (16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024):
+        text = measure("text", size, rounds)
+        binary = measure("binary", size, rounds)
+        print("%10d  %12.2f  %12.2f  %7.1fx" % (size, text * 1000, binary * 1000, text / binary))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+
+"""The transport benchmark suite, with machine-readable results.
+
+Measures, on the local machine and without Qubes OS, each layer of the
+toolkit over the stand-in for qrexec-client-vm in fakebin/, which runs
+what qubes.VMShell would, a shell, locally:
+
+* bombshell  bin/bombshell-client on its own
+* qrun       bin/qrun, which runs bombshell-client
+* plugin     the Qubes connection plugin, through bin/qrun
+
+For every layer it measures how long setting up a session takes, the
+round trip of a command that does nothing, the throughput of bulk data
+in through standard input and out through standard output, uploading
+many small files and downloading a large one.  The commands that the
+bombshell and qrun layers run share one link through a session, the
+way they would when run often; the plugin has a connection of its own.
+
+Every figure is the median of --repeat runs over the same data, so that
+runs are comparable between releases.  --json writes the results to a
+file, and --compare checks them against such a file from an earlier
+run, failing if any figure is worse by more than --tolerance.  Needs
+Ansible installed for the plugin layer, which is skipped otherwise.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.join(here, os.path.pardir)
+bombshell = os.path.join(top, "bin", "bombshell-client")
+qrun = os.path.join(top, "bin", "qrun")
+LAYERS = ("bombshell", "qrun", "plugin")
+CHUNK = 1024 * 1024
+
+# metric: (unit, whether more is better)
+METRICS = {
+    "setup": ("ms", False),
+    "roundtrip": ("ms", False),
+    "stdin": ("MB/s", True),
+    "stdout": ("MB/s", True),
+    "put_small_files": ("files/s", True),
+    "fetch_large_file": ("MB/s", True),
+}
+
+
+class PlayContext(object):
+    shell = 'sh'
+    executable = 'sh'
+    become = False
+    become_method = 'sudo'
+    remote_addr = 'fakevm'
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2]
+
+
+def timed(fn, repeat, prepare=None):
+    '''Return the median number of seconds fn takes, after a warm-up run.
+
+    prepare, if given, runs untimed before every run of fn.
+    '''
+    samples = []
+    for n in range(repeat + 1):
+        if prepare:
+            prepare()
+        start = time.perf_counter()
+        fn()
+        if n:
+            samples.append(time.perf_counter() - start)
+    return median(samples)
+
+
+class CommandLayer(object):
+    '''bombshell-client, or qrun, run once per command.'''
+
+    def __init__(self, program, control_path_dir):
+        self.program = program
+        self.env = dict(os.environ, BOMBSHELL_CONTROL_PATH_DIR=control_path_dir)
+
+    def run(self, cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, persist=5):
+        env = dict(self.env, BOMBSHELL_CONTROL_PERSIST="%d" % persist)
+        return subprocess.Popen([self.program, "fakevm"] + cmd, env=env, stdin=stdin, stdout=stdout)
+
+    def call(self, cmd, persist=5, **kwargs):
+        p = self.run(cmd, persist=persist, **kwargs)
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    def setup(self):
+        self.call(["true"], persist=0)
+
+    def roundtrip(self):
+        self.call(["true"])
+
+    def stdin(self, size):
+        p = self.run(["sh", "-c", "cat > /dev/null"], stdin=subprocess.PIPE)
+        block = b"\0" * CHUNK
+        for _ in range(size // CHUNK):
+            p.stdin.write(block)
+        p.stdin.write(block[:size % CHUNK])
+        p.stdin.close()
+        assert p.wait() == 0
+
+    def stdout(self, size):
+        p = self.run(["head", "-c", "%d" % size, "/dev/zero"], stdout=subprocess.PIPE)
+        total = 0
+        while True:
+            data = p.stdout.read1(CHUNK)
+            if not data:
+                break
+            total = total + len(data)
+        assert p.wait() == 0 and total == size, total
+
+    def put_file(self, in_path, out_path):
+        with open(in_path, "rb") as f:
+            self.call(["sh", "-c", 'cat > "$1"', "sh", out_path], stdin=f)
+
+    def fetch_file(self, in_path, out_path):
+        with open(out_path, "wb") as f:
+            self.call(["cat", in_path], stdout=f)
+
+    def close(self):
+        pass
+
+
+class PluginLayer(object):
+    '''The connection plugin, with a connection of its own.
+
+    The Python the plugin runs on the VM writes a blank line to its
+    standard error when its connection closes, which would land in the
+    results, so what the VM writes there is kept aside, and only what
+    is not blank is passed on.
+    '''
+
+    def __init__(self, control_path_dir):
+        sys.path.insert(0, os.path.join(top, "connection_plugins"))
+        import qubes
+        self.qubes = qubes
+        self.control_path_dir = control_path_dir
+        self.stderr = tempfile.TemporaryFile()
+        self.connection = self.connect()
+
+    def connect(self):
+        saved = os.dup(2)
+        os.dup2(self.stderr.fileno(), 2)
+        try:
+            return self._connect()
+        finally:
+            os.dup2(saved, 2)
+            os.close(saved)
+
+    def _connect(self):
+        c = self.qubes.Connection(PlayContext(), None, transport_cmd=[qrun])
+        c._options = {
+            "management_proxy": None,
+            "compression": "auto",
+            "control_persist": 0,
+            "control_path_dir": self.control_path_dir,
+            "rpc_protocol": "binary",
+            "trace": None,
+        }
+        c._connect()
+        return c
+
+    def setup(self):
+        self.connect().close()
+
+    def roundtrip(self):
+        assert self.connection.exec_command(["true"])[0] == 0
+
+    def stdin(self, size):
+        retcode = self.connection.exec_command_streaming(
+            ["sh", "-c", "cat > /dev/null"], None, None, in_data=b"\0" * size,
+        )
+        assert retcode == 0
+
+    def stdout(self, size):
+        received = []
+        retcode = self.connection.exec_command_streaming(
+            ["head", "-c", "%d" % size, "/dev/zero"],
+            lambda data: received.append(len(data)), None,
+        )
+        assert retcode == 0 and sum(received) == size
+
+    def put_file(self, in_path, out_path):
+        self.connection.put_file(in_path, out_path)
+
+    def fetch_file(self, in_path, out_path):
+        self.connection.fetch_file(in_path, out_path)
+
+    def close(self):
+        self.connection.close()
+        self.stderr.seek(0)
+        errors = self.stderr.read().strip()
+        self.stderr.close()
+        if errors:
+            sys.stderr.write(errors.decode("utf-8", "replace") + "\n")
+
+
+def measure(layer, args, workdir):
+    '''Return the figures of layer, by metric.'''
+    results = {}
+    results["setup"] = timed(layer.setup, args.repeat) * 1000
+    results["roundtrip"] = timed(layer.roundtrip, args.repeat * 10) * 1000
+    results["stdin"] = args.bulk / timed(lambda: layer.stdin(args.bulk), args.repeat) / 1e6
+    results["stdout"] = args.bulk / timed(lambda: layer.stdout(args.bulk), args.repeat) / 1e6
+
+    data = random.Random(0)
+    small = os.path.join(workdir, "small")
+    os.mkdir(small)
+    sources = []
+    for n in range(args.files):
+        path = os.path.join(small, "%d" % n)
+        with open(path, "wb") as f:
+            f.write(data.getrandbits(8 * args.file_size).to_bytes(args.file_size, "little"))
+        sources.append(path)
+    dest = os.path.join(workdir, "dest")
+
+    # Files are written anew every run, because replacing the contents
+    # of a file costs more than writing a new one on some file systems,
+    # ext4 among them, which would measure them rather than the layer.
+    def clear_dest():
+        shutil.rmtree(dest, ignore_errors=True)
+        os.mkdir(dest)
+
+    def put_small_files():
+        for path in sources:
+            layer.put_file(path, os.path.join(dest, os.path.basename(path)))
+    results["put_small_files"] = args.files / timed(put_small_files, args.repeat, clear_dest)
+
+    large = os.path.join(workdir, "large")
+    with open(large, "wb") as f:
+        block = data.getrandbits(8 * CHUNK).to_bytes(CHUNK, "little")
+        for _ in range(args.large // CHUNK):
+            f.write(block)
+        f.write(block[:args.large % CHUNK])
+    fetched = os.path.join(workdir, "fetched")
+
+    def clear_fetched():
+        if os.path.exists(fetched):
+            os.unlink(fetched)
+
+    def fetch_large_file():
+        layer.fetch_file(large, fetched)
+        assert os.path.getsize(fetched) == args.large
+    results["fetch_large_file"] = args.large / timed(fetch_large_file, args.repeat, clear_fetched) / 1e6
+    return results
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(
+            ["git", "-C", top, "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL,
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.time(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''Return the (layer, metric, value, baseline value) that got worse.'''
+    earlier = dict(((r["layer"], r["metric"]), r["value"]) for r in baseline["results"])
+    worse = []
+    for r in results:
+        before = earlier.get((r["layer"], r["metric"]))
+        if not before:
+            continue
+        if METRICS[r["metric"]][1]:
+            regressed = r["value"] < before * (1 - tolerance)
+        else:
+            regressed = r["value"] > before * (1 + tolerance)
+        if regressed:
+            worse.append((r["layer"], r["metric"], r["value"], before))
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--layers", default=",".join(LAYERS), help="comma-separated layers to measure (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per figure, of which the median counts (default: %(default)s)")
+    parser.add_argument("--bulk", type=int, default=64 * CHUNK, help="bytes to send through standard input and output (default: %(default)s)")
+    parser.add_argument("--files", type=int, default=50, help="small files to upload (default: %(default)s)")
+    parser.add_argument("--file-size", type=int, default=4096, help="bytes in every small file (default: %(default)s)")
+    parser.add_argument("--large", type=int, default=64 * CHUNK, help="bytes in the large file to download (default: %(default)s)")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with those in FILE, from --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="fraction a figure may be worse than in --compare (default: %(default)s)")
+    args = parser.parse_args()
+
+    os.environ["PATH"] = os.path.join(here, "fakebin") + os.pathsep + os.environ["PATH"]
+    os.environ.pop("BOMBSHELL_DEBUG", None)
+    os.environ["PYTHONWARNINGS"] = "ignore::DeprecationWarning"
+    parameters = dict((k, getattr(args, k)) for k in ("repeat", "bulk", "files", "file_size", "large"))
+    results = []
+    print("%-10s  %-16s  %12s  %-8s" % ("layer", "metric", "value", "unit"))
+    for name in args.layers.split(","):
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        try:
+            control_path_dir = os.path.join(workdir, "cp")
+            os.mkdir(control_path_dir)
+            if name == "plugin":
+                try:
+                    layer = PluginLayer(control_path_dir)
+                except ImportError as e:
+                    print("%-10s  skipped, Ansible is needed: %s" % (name, e))
+                    continue
+            else:
+                layer = CommandLayer(bombshell if name == "bombshell" else qrun, control_path_dir)
+            try:
+                figures = measure(layer, args, workdir)
+            finally:
+                layer.close()
+                # Let the session daemons of this layer go.
+                shutil.rmtree(control_path_dir, ignore_errors=True)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        for metric in METRICS:
+            unit = METRICS[metric][0]
+            print("%-10s  %-16s  %12.2f  %-8s" % (name, metric, figures[metric], unit))
+            results.append({"layer": name, "metric": metric, "value": figures[metric], "unit": unit})
+
+    if args.json:
+        report = {
+            "environment": environment(),
+            "parameters": parameters,
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters:
+            print("WARNING the parameters of %s are not those of this run" % (args.compare,))
+        worse = compare(results, baseline, args.tolerance)
+        for layer, metric, value, before in worse:
+            print("REGRESSION %s %s: %.2f %s, was %.2f" % (layer, metric, value, METRICS[metric][0], before))
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = """
+    author:
+        - Manuel Amador (Rudd-O)
+    name: qubes_trace
+    short_description: sum up the timings traced by the qubes connection plugin
+    description:
+        - At the end of every play, prints a table of where the qubes
+          connection plugin spent its time, per host and phase, from
+          the trace file that plugin appends to when C(qubes_trace)
+          is set.
+        - Only the records written since the playbook started count.
+    type: aggregate
+    requirements:
+      - enable in configuration
+      - the same trace file set for the qubes connection plugin
+    options:
+      trace:
+        description: File the qubes connection plugin appends its timings to.
+        default: ''
+        env:
+          - name: QUBES_TRACE
+        ini:
+          - section: callback_qubes_trace
+            key: trace
+"""
+
+import collections
+import json
+import os
+
+from ansible.plugins.callback import CallbackBase
+
+
+PHASES = ("spawn", "handshake", "lease", "exec", "put", "fetch", "put_tree", "fetch_tree")
+
+
+def summarize(records):
+    '''Add records up per (host, phase), in the order hosts were seen.'''
+    totals = collections.OrderedDict()
+    for r in records:
+        key = (r["host"], r["phase"])
+        t = totals.get(key)
+        if t is None:
+            t = totals[key] = dict(count=0, seconds=0.0, longest=0.0, bytes_in=0, bytes_out=0, remote_wait=0.0)
+        t["count"] = t["count"] + 1
+        t["seconds"] = t["seconds"] + r["seconds"]
+        t["longest"] = max(t["longest"], r["seconds"])
+        t["bytes_in"] = t["bytes_in"] + r.get("bytes_in", 0)
+        t["bytes_out"] = t["bytes_out"] + r.get("bytes_out", 0)
+        t["remote_wait"] = t["remote_wait"] + r.get("remote_wait", 0.0)
+    order = dict((p, n) for n, p in enumerate(PHASES))
+    hosts = list(collections.OrderedDict.fromkeys(h for h, _ in totals))
+    return sorted(totals.items(), key=lambda kv: (hosts.index(kv[0][0]), order.get(kv[0][1], len(order)), kv[0][1]))
+
+
+def format_table(summary):
+    lines = ["%-24s %-10s %6s %9s %9s %9s %9s %9s %8s %7s" % (
+        "host", "phase", "count", "total s", "mean ms", "max ms", "MB in", "MB out", "MB/s", "wait %",
+    )]
+    for (host, phase), t in summary:
+        moved = t["bytes_in"] + t["bytes_out"]
+        lines.append("%-24s %-10s %6d %9.3f %9.1f %9.1f %9.2f %9.2f %8s %7s" % (
+            host, phase, t["count"], t["seconds"],
+            1000.0 * t["seconds"] / t["count"], 1000.0 * t["longest"],
+            t["bytes_in"] / 1e6, t["bytes_out"] / 1e6,
+            "%.1f" % (moved / 1e6 / t["seconds"]) if moved and t["seconds"] else "-",
+            "%.0f" % (100.0 * t["remote_wait"] / t["seconds"]) if t["seconds"] and phase not in ("spawn", "handshake", "lease") else "-",
+        ))
+    return "\n".join(lines)
+
+
+class CallbackModule(CallbackBase):
+    '''
+    Prints a summary of the time the qubes connection plugin spent
+    starting sessions, running commands and moving files, per host.
+    '''
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'qubes_trace'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        self.offset = 0
+
+    def _path(self):
+        path = self.get_option("trace")
+        return os.path.expanduser(path) if path else None
+
+    def v2_playbook_on_start(self, playbook):
+        path = self._path()
+        try:
+            self.offset = os.path.getsize(path) if path else 0
+        except OSError:
+            self.offset = 0
+
+    def v2_playbook_on_stats(self, stats):
+        path = self._path()
+        if not path:
+            return
+        records = []
+        try:
+            with open(path, "rb") as f:
+                f.seek(self.offset)
+                for line in f:
+                    try:
+                        records.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        continue
+        except (IOError, OSError) as e:
+            self._display.warning("could not read the qubes trace in %s: %s" % (path, e))
+            return
+        if not records:
+            return
+        self._display.banner("QUBES CONNECTION TRACE")
+        self._display.display(format_table(summarize(records)))
@@ -0,0 +1,135 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+bombshell = os.path.join(here, os.path.pardir, "bin", "bombshell-client")
+fakebin = os.path.join(here, os.path.pardir, "bench", "fakebin")
+
+PERSIST = 1
+
+
+class TestBombshellSession(unittest.TestCase):
+    """Commands run by bombshell-client through a session daemon.
+
+    The link to the VM is the stand-in for qrexec-client-vm in
+    bench/fakebin, which runs the other end of bombshell-client on
+    this machine.
+    """
+
+    def setUp(self):
+        self.cpdir = tempfile.mkdtemp()
+        self.env = dict(
+            os.environ,
+            BOMBSHELL_CONTROL_PERSIST="%d" % PERSIST,
+            BOMBSHELL_CONTROL_PATH_DIR=self.cpdir,
+        )
+        self.env["PATH"] = fakebin + os.pathsep + self.env["PATH"]
+        self.sock = os.path.join(self.cpdir, "fakevm.sock")
+
+    def tearDown(self):
+        self.wait_expired()
+        shutil.rmtree(self.cpdir)
+
+    def wait_expired(self, timeout=PERSIST + 5):
+        deadline = time.time() + timeout
+        while os.path.exists(self.sock) and time.time() < deadline:
+            time.sleep(0.1)
+        return not os.path.exists(self.sock)
+
+    def start(self, cmd):
+        return subprocess.Popen(
+            [bombshell, "fakevm"] + cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self.env,
+        )
+
+    def run_in_session(self, cmd, in_data=b""):
+        p = self.start(cmd)
+        stdout, stderr = p.communicate(in_data, timeout=30)
+        return p.returncode, stdout, stderr
+
+    def remote_pid(self):
+        retcode, stdout, _ = self.run_in_session(['sh', '-c', 'echo $PPID'])
+        self.assertEqual(retcode, 0)
+        return int(stdout)
+
+    def test_exit_status_and_outputs(self):
+        self.assertEqual(
+            self.run_in_session(['sh', '-c', 'echo out; echo err >&2; exit 3']),
+            (3, b'out\n', b'err\n'),
+        )
+        self.assertEqual(self.run_in_session(['true']), (0, b'', b''))
+        retcode, stdout, stderr = self.run_in_session(['/does/not/exist'])
+        self.assertEqual((retcode, stdout), (127, b''))
+        self.assertTrue(os.path.exists(self.sock))
+
+    def test_signal_exit_status(self):
+        cmd = ['sh', '-c', 'kill -9 $$']
+        self.assertEqual(self.run_in_session(cmd)[0], 137)
+        self.env["BOMBSHELL_CONTROL_PERSIST"] = "0"
+        self.assertEqual(self.run_in_session(cmd)[0], 137)
+
+    def test_falls_back_when_daemon_goes_away(self):
+        # A daemon that hangs up before opening the command, as one
+        # that is ending does.
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.sock)
+        listener.listen(1)
+
+        def hang_up():
+            conn, _ = listener.accept()
+            conn.recv(65536)
+            conn.close()
+
+        t = threading.Thread(target=hang_up)
+        t.start()
+        try:
+            self.assertEqual(
+                self.run_in_session(['sh', '-c', 'cat; exit 4'], b'hello'),
+                (4, b'hello', b''),
+            )
+        finally:
+            t.join()
+            listener.close()
+            os.unlink(self.sock)
+
+    def test_stdin_eof(self):
+        data = os.urandom(3000000)
+        self.assertEqual(self.run_in_session(['cat'], data), (0, data, b''))
+        self.assertEqual(self.run_in_session(['wc', '-c'], b'hello'), (0, b'5\n', b''))
+        self.assertEqual(self.run_in_session(['cat']), (0, b'', b''))
+
+    def test_concurrent_commands_share_the_link(self):
+        first = self.remote_pid()
+        start = time.time()
+        procs = [
+            self.start(['sh', '-c', 'cat; sleep 1; echo $PPID; exit %d' % n])
+            for n in range(4)
+        ]
+        for n, p in enumerate(procs):
+            p.stdin.write(b'%d\n' % n)
+            p.stdin.close()
+        results = [(p.stdout.read(), p.stderr.read(), p.wait(30)) for p in procs]
+        elapsed = time.time() - start
+        for n, (stdout, stderr, retcode) in enumerate(results):
+            self.assertEqual(retcode, n)
+            self.assertEqual(stdout, b'%d\n%d\n' % (n, first))
+            self.assertEqual(stderr, b'')
+        # One after the other, they would take four seconds.
+        self.assertTrue(elapsed < 3, elapsed)
+
+    def test_session_expires(self):
+        first = self.remote_pid()
+        self.assertEqual(self.remote_pid(), first)
+        self.assertTrue(self.wait_expired())
+        second = self.remote_pid()
+        self.assertNotEqual(first, second)
@@ -1,15 +1,21 @@
 import sys, os ; sys.path.append(os.path.dirname(__file__))
 
 import contextlib
+import hashlib
+import json
+import struct
+import zlib
 try:
     from StringIO import StringIO
     BytesIO = StringIO
 except ImportError:
     from io import StringIO, BytesIO
 import unittest
+import shutil
 import tempfile
 
 import qubes
+from ansible import errors
 
 
 
@@ -26,9 +32,17 @@ if sys.version_info.major == 3:
         (['sh', '-c', 'echo yes'], '', 0, b'yes\n', ''),
         (['sh', '-c', 'echo yes >&2'], '', 0, '', b'yes\n'),
     ]
+    cases_with_rpc = [
+        (['true'], None, 0, b'', b''),
+        (['false'], None, 1, b'', b''),
+        (['sh', '-c', 'echo yes'], None, 0, b'yes\n', b''),
+        (['sh', '-c', 'echo yes >&2'], None, 0, b'', b'yes\n'),
+        (['cat'], b'\x00\n\\\'"' * 100000, 0, b'\x00\n\\\'"' * 100000, b''),
+    ]
 else:
     cases = []
     cases_with_harness = []
+    cases_with_rpc = []
 
 
 class MockPlayContext(object):
@@ -40,12 +54,20 @@ class MockPlayContext(object):
 
 
 @contextlib.contextmanager
-def local_connection():
+def local_connection(**options):
     c = qubes.Connection(
         MockPlayContext(), None,
         transport_cmd=['sh', '-c', '"$@"']
     )
-    c._options = {"management_proxy": None}
+    c._options = {
+        "management_proxy": None,
+        "compression": "auto",
+        "control_persist": 0,
+        "control_path_dir": None,
+        "rpc_protocol": "binary",
+        "trace": None,
+    }
+    c._options.update(options)
     try:
         yield c
     finally:
@@ -65,13 +87,203 @@ class TestBasicThings(unittest.TestCase):
 
     def test_exec_command_with_harness(self):
         for cmd, in_, ret, out, err in cases_with_harness:
-            with local_connection() as c:
+            with local_connection(rpc_protocol="text") as c:
                 retcode, stdout, stderr = c.exec_command(cmd)
                 self.assertEqual(ret, retcode)
                 self.assertEqual(out, stdout)
                 self.assertEqual(err, stderr)
             self.assertEqual(c._transport, None)
 
+    def test_exec_command_with_rpc(self):
+        for cmd, in_, ret, out, err in cases_with_rpc:
+            with local_connection() as c:
+                retcode, stdout, stderr = c.exec_command(cmd, in_data=in_)
+                self.assertEqual(ret, retcode)
+                self.assertEqual(out, stdout)
+                self.assertEqual(err, stderr)
+            self.assertEqual(c._transport, None)
+
+    def test_exec_command_streaming(self):
+        stdout, stderr = [], []
+        with local_connection() as c:
+            retcode = c.exec_command_streaming(
+                ['sh', '-c', 'head -c 3000000 /dev/zero ; echo done >&2 ; exit 3'],
+                stdout.append, stderr.append,
+            )
+        self.assertEqual(retcode, 3)
+        self.assertTrue(len(stdout) > 1)
+        self.assertEqual(b''.join(stdout), b'\0' * 3000000)
+        self.assertEqual(b''.join(stderr), b'done\n')
+
+    def test_exec_command_ignoring_large_input(self):
+        with local_connection() as c:
+            self.assertEqual(
+                c.exec_command(['true'], in_data=b'x' * 3000000),
+                (0, b'', b''),
+            )
+            self.assertEqual(c.exec_command(['echo', 'ok']), (0, b'ok\n', b''))
+
+    def test_payload_segments(self):
+        zipped = b"    zip_data='" + b"QUJD" * 10000 + b"',\n"
+        data = b"#!/usr/bin/python\nimport sys\n" + zipped + b"    params='{}',\n)\n"
+        manifest, payloads = qubes._payload_segments(data)
+        self.assertEqual(list(payloads.values()), [zipped])
+        self.assertEqual([entry[:1] for entry in manifest], [b"L", b"K", b"L"])
+        self.assertEqual(b"".join(
+            payloads[entry[1:]] if entry[:1] == b"K" else entry[1:] for entry in manifest
+        ), data)
+        self.assertEqual(qubes._payload_segments(b"short\n" * 10000), None)
+        self.assertEqual(qubes._payload_segments(b"short"), None)
+
+    def test_payload_cache_evicts_least_recently_used(self):
+        cache = qubes.PayloadCache(10)
+        cache.put(b"a", b"1234")
+        cache.put(b"b", b"1234")
+        self.assertEqual(cache.get(b"a"), b"1234")
+        cache.put(b"c", b"1234")
+        self.assertTrue(b"a" in cache and b"c" in cache)
+        self.assertFalse(b"b" in cache)
+        cache.put(b"d", b"x" * 20)
+        self.assertEqual(list(cache.entries), [b"d"])
+
+    def test_exec_command_with_payload_cache(self):
+        zipped = b"zip_data='" + b"QUJD" * 100000 + b"',\n"
+        for codec in "none", "zlib":
+            with local_connection(compression=codec) as c:
+                for n in range(3):
+                    data = b"params='%d'\n" % n + zipped + b"end\n"
+                    self.assertEqual(c.exec_command(['cat'], in_data=data), (0, data, b''))
+                self.assertEqual((c._payload_hits, c._payload_misses), (2, 1))
+                self.assertRaises(
+                    FileNotFoundError,
+                    c.exec_command, ['/does/not/exist'], in_data=zipped,
+                )
+                self.assertEqual(c.exec_command(['echo', 'ok']), (0, b'ok\n', b''))
+
+    def test_put_file_many_windows(self):
+        in_text = os.urandom(qubes.BUFSIZE * qubes.PUT_WINDOW * 3 + 12345)
+        with tempfile.NamedTemporaryFile() as x:
+            x.write(in_text)
+            x.flush()
+            with tempfile.NamedTemporaryFile() as y:
+                with local_connection() as c:
+                    c.put_file(in_path=x.name, out_path=y.name)
+                    self.assertRaises(
+                        FileNotFoundError,
+                        c.put_file, in_path=x.name, out_path="/does/not/exist",
+                    )
+                    self.assertEqual(c.exec_command(['true']), (0, b'', b''))
+                y.seek(0)
+                out_text = y.read()
+        self.assertEqual(in_text, out_text)
+
+    def test_rpc_errors_leave_connection_usable(self):
+        with local_connection() as c:
+            with tempfile.NamedTemporaryFile() as y:
+                self.assertRaises(
+                    FileNotFoundError,
+                    c.fetch_file, in_path="/does/not/exist", out_path=y.name,
+                )
+            self.assertRaises(
+                FileNotFoundError,
+                c.exec_command, ['/does/not/exist'],
+            )
+            self.assertEqual(c.exec_command(['true']), (0, b'', b''))
+
+    def test_compression(self):
+        text = b"".join(b"line %d of a compressible file\n" % i for i in range(200000))
+        for codec in qubes.codecs_available():
+            with local_connection(compression=codec) as c:
+                self.assertEqual(
+                    c.exec_command(['cat'], in_data=text),
+                    (0, text, b''),
+                )
+                self.assertEqual(c._codec, codec)
+                with tempfile.NamedTemporaryFile() as x:
+                    x.write(text)
+                    x.flush()
+                    with tempfile.NamedTemporaryFile() as y:
+                        c.put_file(in_path=x.name, out_path=y.name)
+                        self.assertEqual(y.read(), text)
+                    with tempfile.NamedTemporaryFile() as y:
+                        c.fetch_file(in_path=x.name, out_path=y.name)
+                        self.assertEqual(y.read(), text)
+
+    def test_deflater_skips_what_does_not_compress(self):
+        text = b"compressible " * 1000
+        deflate = qubes.Deflater("zlib")
+        body, flags = deflate.pack(text)
+        self.assertEqual(flags, qubes.CODEC_IDS["zlib"])
+        self.assertTrue(len(body) < len(text) / 10)
+        self.assertEqual(deflate.pack(b"small"), (b"small", 0))
+        noise = os.urandom(qubes.BUFSIZE)
+        self.assertEqual(deflate.pack(noise), (noise, 0))
+        gzipped = b"\x1f\x8b" + text
+        deflate = qubes.Deflater("zlib")
+        self.assertEqual(deflate.pack(gzipped), (gzipped, 0))
+        self.assertEqual(deflate.pack(text), (text, 0))
+        self.assertEqual(qubes.Deflater(None).pack(text), (text, 0))
+
+    def test_delta_frames_rebuild_file(self):
+        old = os.urandom(3000000)
+        new = (
+            old[:500000] + os.urandom(1000) + old[500000:1000000] +
+            old[1005000:2000000] + b"changed" + old[2000007:] + os.urandom(10000)
+        )
+        block_size = qubes._delta_block_size(len(old))
+        signatures = {}
+        for index, pos in enumerate(range(0, len(old), block_size)):
+            block = old[pos:pos + block_size]
+            strong = hashlib.blake2b(block, digest_size=16).digest()
+            signatures.setdefault(zlib.adler32(block), {})[strong] = index
+        for roll_limit in qubes.DELTA_ROLL_LIMIT, 0:
+            deflate = qubes.Deflater(None)
+            rebuilt = []
+            saved, qubes.DELTA_ROLL_LIMIT = qubes.DELTA_ROLL_LIMIT, roll_limit
+            try:
+                for op, body, flags in qubes._delta_frames(BytesIO(new), signatures, block_size, deflate):
+                    self.assertTrue(len(body) <= qubes.BUFSIZE)
+                    if op == qubes.OP_COPY:
+                        first, count = struct.unpack("!QI", body)
+                        rebuilt.append(old[first * block_size:(first + count) * block_size])
+                    else:
+                        rebuilt.append(bytes(body))
+            finally:
+                qubes.DELTA_ROLL_LIMIT = saved
+            self.assertEqual(b"".join(rebuilt), new)
+            if roll_limit:
+                self.assertTrue(deflate.raw < 10 * block_size)
+            else:
+                self.assertTrue(deflate.raw < len(new) / 2)
+
+    def test_update_file_delta(self):
+        old = os.urandom(qubes.DELTA_MIN_SIZE * 2)
+        new = old[:1000] + b"inserted" + old[1000:] + b"appended"
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src, dst = os.path.join(tmpdir, "src"), os.path.join(tmpdir, "dst")
+            with open(dst, "wb") as f:
+                f.write(old)
+            os.chmod(dst, 0o640)
+            with open(src, "wb") as f:
+                f.write(new)
+            with local_connection() as c:
+                c.update_file(in_path=src, out_path=dst)
+                with open(dst, "rb") as f:
+                    self.assertEqual(f.read(), new)
+                self.assertEqual(os.stat(dst).st_mode & 0o777, 0o640)
+                inode = os.stat(dst).st_ino
+                c.update_file(in_path=src, out_path=dst)
+                self.assertEqual(os.stat(dst).st_ino, inode)
+                self.assertEqual(sorted(os.listdir(tmpdir)), ["dst", "src"])
+                # put_file never tries a delta, even over a copy.
+                c._put_file_delta = None
+                c.put_file(in_path=src, out_path=dst)
+                with open(dst, "rb") as f:
+                    self.assertEqual(f.read(), new)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_fetch_file_with_harness(self):
         if sys.version_info.major == 2:
             in_text = "abcd"
@@ -80,12 +292,143 @@ class TestBasicThings(unittest.TestCase):
         with tempfile.NamedTemporaryFile() as x:
             x.write(in_text)
             x.flush()
-            with tempfile.NamedTemporaryFile() as y:
-                with local_connection() as c:
-                    c.fetch_file(in_path=x.name, out_path=y.name)
-                    y.seek(0)
-                    out_text = y.read()
-        self.assertEqual(in_text, out_text)
+            for protocol in "text", "binary":
+                with tempfile.NamedTemporaryFile() as y:
+                    with local_connection(rpc_protocol=protocol) as c:
+                        c.fetch_file(in_path=x.name, out_path=y.name)
+                        y.seek(0)
+                        out_text = y.read()
+                self.assertEqual(in_text, out_text)
+
+    def test_rpc_fetch_of_shrinking_file_fails(self):
+        for cut in qubes.BUFSIZE, qubes.BUFSIZE // 2:
+            with tempfile.NamedTemporaryFile() as x, tempfile.TemporaryFile() as out:
+                x.write(b"x" * qubes.BUFSIZE * 4)
+                x.flush()
+                real = qubes.send_file_range
+
+                def send_then_cut(*args):
+                    sent = real(*args)
+                    os.truncate(x.name, cut)
+                    return sent
+
+                saved = sys.stdout
+                qubes.send_file_range, sys.stdout = send_then_cut, out
+                try:
+                    qubes.rpc_fetch(1, qubes.pack_fields([x.name.encode("utf-8"), b"%d" % qubes.BUFSIZE]), 0)
+                finally:
+                    qubes.send_file_range, sys.stdout = real, saved
+                out.seek(0)
+                frames = []
+                while True:
+                    frame = qubes.rpc_recv(out)
+                    if frame is None:
+                        break
+                    frames.append(frame)
+            self.assertEqual([op for op, _, _, _ in frames], [qubes.OP_DATA, qubes.OP_ERROR])
+            self.assertTrue(b"shrank" in frames[-1][3])
+
+    def test_fetch_file_large_and_special(self):
+        in_text = os.urandom(qubes.FETCH_MAX_CHUNK * 3 + 12345)
+        with open("/proc/version", "rb") as f:
+            version = f.read()
+        with tempfile.NamedTemporaryFile() as x:
+            x.write(in_text)
+            x.flush()
+            for protocol in "text", "binary":
+                with local_connection(rpc_protocol=protocol) as c:
+                    for in_path, expected in (x.name, in_text), ("/proc/version", version):
+                        with tempfile.NamedTemporaryFile() as y:
+                            c.fetch_file(in_path=in_path, out_path=y.name)
+                            self.assertEqual(y.read(), expected)
+                    with tempfile.NamedTemporaryFile() as y:
+                        self.assertRaises(
+                            (IOError, OSError),
+                            c.fetch_file, in_path="/does/not/exist", out_path=y.name,
+                        )
+
+    def make_tree(self, root):
+        os.makedirs(os.path.join(root, "sub", "deeper"))
+        for name, data in (("a", b"alpha"), ("sub/b", os.urandom(200000)), ("sub/deeper/c", b"")):
+            with open(os.path.join(root, name), "wb") as f:
+                f.write(data)
+            os.utime(os.path.join(root, name), (1234567890, 1234567890))
+        os.chmod(os.path.join(root, "a"), 0o751)
+        os.symlink("../a", os.path.join(root, "sub", "link"))
+        os.utime(os.path.join(root, "sub", "deeper"), (1234567890, 1234567890))
+
+    def assert_same_tree(self, src, dst, names=None):
+        for name in names or [""]:
+            for parent, dirs, files in os.walk(os.path.join(src, name)):
+                for entry in dirs + files:
+                    path = os.path.join(parent, entry)
+                    copy = os.path.join(dst, os.path.relpath(path, src))
+                    if os.path.islink(path):
+                        self.assertEqual(os.readlink(path), os.readlink(copy))
+                        continue
+                    st, copy_st = os.stat(path), os.stat(copy)
+                    self.assertEqual(st.st_mode, copy_st.st_mode)
+                    self.assertEqual(int(st.st_mtime), int(copy_st.st_mtime))
+                    if entry in files:
+                        with open(path, "rb") as f, open(copy, "rb") as g:
+                            self.assertEqual(f.read(), g.read())
+
+    def test_put_and_fetch_tree(self):
+        for protocol in "text", "binary":
+            tmpdir = tempfile.mkdtemp()
+            try:
+                src, dst, back = [os.path.join(tmpdir, x) for x in ("src", "dst", "back")]
+                self.make_tree(src)
+                with local_connection(rpc_protocol=protocol) as c:
+                    c.put_tree(src, dst)
+                    self.assert_same_tree(src, dst)
+                    c.fetch_tree(dst, back)
+                    self.assert_same_tree(src, back)
+                    c.put_tree(src, dst + "2", names=["a", "sub/deeper"])
+                    self.assert_same_tree(src, dst + "2", names=["a", "sub/deeper"])
+                    self.assertFalse(os.path.exists(os.path.join(dst + "2", "sub", "b")))
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def test_fetch_tree_refuses_escapes(self):
+        for protocol in "text", "binary":
+            tmpdir = tempfile.mkdtemp()
+            try:
+                src, dst = os.path.join(tmpdir, "src"), os.path.join(tmpdir, "dst")
+                self.make_tree(src)
+                os.symlink("/etc/passwd", os.path.join(src, "sub", "passwd"))
+                with local_connection(rpc_protocol=protocol) as c:
+                    self.assertRaises(errors.AnsibleError, c.fetch_tree, src, dst)
+                    self.assertEqual(c.exec_command(['echo', 'ok'])[:2], (0, b'ok\n'))
+                    self.assertRaises(
+                        (OSError, errors.AnsibleError),
+                        c.put_tree, src, os.path.join(src, "a", "not-a-dir"),
+                    )
+                    self.assertEqual(c.exec_command(['echo', 'ok'])[:2], (0, b'ok\n'))
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as d:
+            trace = os.path.join(d, "trace")
+            src, dst = os.path.join(d, "src"), os.path.join(d, "dst")
+            with open(src, "wb") as f:
+                f.write(b"x" * 300000)
+            with local_connection(trace=trace) as c:
+                self.assertEqual(c.exec_command(['sh', '-c', 'cat; exit 2'], in_data=b'hello'), (2, b'hello', b''))
+                c.put_file(src, dst)
+                c.fetch_file(dst, src)
+                self.assertFalse(os.path.exists(trace))
+            with open(trace) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([r["phase"] for r in records], ["spawn", "handshake", "exec", "put", "fetch"])
+        for r in records:
+            self.assertEqual(r["host"], "127.0.0.7")
+            self.assertEqual(r["pid"], os.getpid())
+        exec_, put, fetch = records[2:]
+        self.assertEqual((exec_["rc"], exec_["bytes_out"], exec_["bytes_in"]), (2, 5, 5))
+        self.assertAlmostEqual(exec_["remote_wait"] + exec_["local_wait"], exec_["seconds"])
+        self.assertEqual((put["bytes_out"], fetch["bytes_in"]), (300000, 300000))
 
     def test_put_file_with_harness(self):
         if sys.version_info.major == 2:
@@ -95,9 +438,42 @@ class TestBasicThings(unittest.TestCase):
         with tempfile.NamedTemporaryFile() as x:
             x.write(in_text)
             x.flush()
-            with tempfile.NamedTemporaryFile() as y:
-                with local_connection() as c:
-                    c.put_file(in_path=x.name, out_path=y.name)
-                    y.seek(0)
-                    out_text = y.read()
-        self.assertEqual(in_text, out_text)
+            for protocol in "text", "binary":
+                with tempfile.NamedTemporaryFile() as y:
+                    with local_connection(rpc_protocol=protocol) as c:
+                        c.put_file(in_path=x.name, out_path=y.name)
+                        y.seek(0)
+                        out_text = y.read()
+                self.assertEqual(in_text, out_text)
+
+
+class TestSharedSession(unittest.TestCase):
+
+    def setUp(self):
+        self.cpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cpdir)
+
+    def remote_pid(self, c):
+        _, stdout, _ = c.exec_command(['sh', '-c', 'echo $PPID'])
+        return int(stdout)
+
+    def test_connections_share_remote_python(self):
+        opts = dict(control_persist=2, control_path_dir=self.cpdir)
+        with local_connection(**opts) as c:
+            first = self.remote_pid(c)
+        with local_connection(**opts) as c:
+            second = self.remote_pid(c)
+            c.reset()
+        self.assertEqual(first, second)
+
+    def test_aborted_lease_kills_session(self):
+        opts = dict(control_persist=2, control_path_dir=self.cpdir)
+        with local_connection(**opts) as c:
+            first = self.remote_pid(c)
+            c._abort_transport()
+        with local_connection(**opts) as c:
+            second = self.remote_pid(c)
+            c.reset()
+        self.assertNotEqual(first, second)
@@ -0,0 +1,81 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+fakebin = os.path.join(here, os.path.pardir, "bench", "fakebin")
+sys.path.append(os.path.join(here, os.path.pardir, "action_plugins"))
+
+import qubes_pass
+
+
+def load_lookup():
+    path = os.path.join(here, os.path.pardir, "lookup_plugins", "qubes-pass.py")
+    spec = importlib.util.spec_from_file_location("qubes_pass_lookup", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestQubesPassCache(unittest.TestCase):
+    """Lookups cached by the qubes-pass lookup, and written by the qubes_pass action.
+
+    qvm-pass is the stand-in in bench/fakebin, which keeps entries in
+    files and ignores the vault VM.
+    """
+
+    # The cache daemon outlives every test, and keeps the environment of
+    # the first, so they all share one store, with names of their own.
+    @classmethod
+    def setUpClass(cls):
+        cls.store = tempfile.mkdtemp()
+        cls.saved = dict((k, os.environ.get(k)) for k in ("PATH", "QVM_PASS_STORE", "QUBES_PASS_TTL"))
+        os.environ["PATH"] = fakebin + os.pathsep + os.environ["PATH"]
+        os.environ["QVM_PASS_STORE"] = cls.store
+        os.environ["QUBES_PASS_TTL"] = "300"
+
+    @classmethod
+    def tearDownClass(cls):
+        for k, v in cls.saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        shutil.rmtree(cls.store)
+
+    def setUp(self):
+        self.lookup = load_lookup().LookupModule()
+        self.name = "test/%s" % self.id().rsplit(".", 1)[-1]
+
+    def write(self, content):
+        action = object.__new__(qubes_pass.ActionModule)
+        action._play_context = types.SimpleNamespace(check_mode=False)
+        action._loader = action._templar = None
+        action._shared_loader_obj = types.SimpleNamespace(
+            lookup_loader=types.SimpleNamespace(get=lambda *a, **kw: self.lookup),
+        )
+        result = action.present(qubes_pass.wanted_entries({"name": self.name, "content": content}), 1)
+        self.assertTrue(result["changed"], result)
+
+    def test_write_then_lookup(self):
+        self.write("old")
+        for vm in None, "vault":
+            self.assertEqual(self.lookup.run([self.name], create=False, vm=vm), ["old"])
+        self.write("new")
+        for vm in None, "vault":
+            self.assertEqual(self.lookup.run([self.name], create=False, vm=vm), ["new"])
+
+    def test_invalidate_in_one_vm(self):
+        self.write("old")
+        for vm in "vault", "other":
+            self.assertEqual(self.lookup.run([self.name], create=False, vm=vm), ["old"])
+        with open(os.path.join(self.store, self.name), "w") as f:
+            f.write("new\n")
+        self.lookup.invalidate([self.name], vm="vault")
+        self.assertEqual(self.lookup.run([self.name], create=False, vm="vault"), ["new"])
+        self.assertEqual(self.lookup.run([self.name], create=False, vm="other"), ["old"])
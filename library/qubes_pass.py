@@ -12,8 +12,9 @@ description:
     before being stored.
 options:
   name:
-    required: true
-    description: name of the entry for qvm-pass
+    required: false
+    description: name of the entry for qvm-pass; either
+                 this or entries is required.
   state:
     required: false
     choices: [ "present" ]
@@ -22,6 +23,19 @@ options:
     required: false
     description: set the name to these contents, when
                  state is present.
+  entries:
+    required: false
+    description: many entries to set at once, either as a
+                 dictionary of names to contents, or as a list
+                 of dictionaries with name and content keys.
+                 All of them are read before any is written, and
+                 only those whose contents differ are written,
+                 which is much faster than a loop over them.
+  parallelism:
+    required: false
+    default: 8
+    description: how many entries to read at the same time.
+                 Entries are always written one after the other.
 """
 
 EXAMPLES = r"""
@@ -35,4 +49,32 @@ EXAMPLES = r"""
       multi
       line
       string
+
+- qubes_pass:
+    entries:
+      key/a/b/c: password
+      key/d/e/f: another password
+
+- qubes_pass:
+    entries: "{{ users | map(attribute='secret') | list }}"
+  vars:
+    users:
+    - secret: {name: users/john, content: hunter2}
+    - secret: {name: users/jane, content: correct horse}
+"""
+
+RETURN = r"""
+created:
+  description: the entries that did not exist.
+  type: list
+updated:
+  description: the entries whose contents were different.
+  type: list
+calls:
+  description: how many times qvm-pass was called to read and to write entries.
+  type: dict
+  sample: {"get": 100, "insert": 10}
+elapsed:
+  description: how many seconds reading and writing the entries took.
+  type: float
 """
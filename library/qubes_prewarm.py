@@ -0,0 +1,49 @@
+DOCUMENTATION = """
+---
+module: qubes_prewarm
+author: Rudd-O
+short_description: Start Qubes VMs and their sessions ahead of time.
+description:
+  - This module connects to the given Qubes VMs, several at a time,
+    through the qubes connection plugin.  This makes dom0 start the
+    VMs that are halted, and leaves shared sessions open with those
+    that keep them (see C(qubes_control_persist)), so that later tasks
+    find them ready.
+    Run it once, at the start of a play, so that the VMs boot
+    alongside one another instead of one after another as their
+    first tasks run.
+    Hosts that do not use the qubes connection are skipped.  VMs that
+    cannot be started are reported as warnings, and do not fail the
+    task.
+options:
+  hosts:
+    required: false
+    default: the hosts of the play
+    description: names of the hosts to start.
+  parallelism:
+    required: false
+    default: 8
+    description: how many VMs to start at the same time.
+"""
+
+EXAMPLES = r"""
+- qubes_prewarm:
+  run_once: true
+
+- qubes_prewarm:
+    hosts: "{{ groups['workstations'] }}"
+    parallelism: 4
+  run_once: true
+"""
+
+RETURN = r"""
+ready:
+  description: seconds each VM took to be ready, by host name.
+  type: dict
+failures:
+  description: why each VM that could not be started failed, by host name.
+  type: dict
+elapsed:
+  description: seconds all VMs took to be ready.
+  type: float
+"""
@@ -20,10 +20,47 @@ options:
         1. The file you specified in `description`.
         2. An additional file with a .top extension instead of the
         original extension of the file you specified.
+  waves:
+    required: false
+    type: bool
+    default: false
+    description:
+      - |
+        Also create one recipe per wave of VMs, named after `dest`
+        with `-wave-1`, `-wave-2`... before the extension.  A VM comes
+        in the wave after the last of the VMs it needs (its template,
+        source or netvm), so realizing the recipes of the waves in
+        order, with M(qubessls), creates every VM after those it
+        needs.  The names of these recipes are returned as
+        `wave_sls`.  Whether or not this is set, the VMs of every
+        wave are returned as `waves`, and VMs that need one another
+        in a cycle are an error.
+  parallel:
+    required: false
+    type: bool
+    default: true
+    description:
+      - Have Salt create the VMs of each wave recipe at the same time.
+  prune:
+    required: false
+    type: bool
+    default: false
+    description:
+      - |
+        Read the properties of all VMs on the dom0 with one `qvm-ls`
+        command, and leave out of the recipe the preferences that
+        already have the wanted value, starting VMs already running,
+        and VMs that exist and have nothing else to change.  Services
+        are always kept, since `qvm-ls` does not show them.  How many
+        VMs and preferences were left out is returned as `pruned`.
+        Preferences `qvm-ls` has no column for are always kept, and
+        if `qvm-ls` cannot be run, nothing is pruned.
   others:
     description:
-      - All arguments accepted by the M(template) module also work here,
-        except for `src` and `content`.
+      - All arguments accepted by the M(copy) module also work here,
+        except for `src` and `content`.  Without any, files that
+        already have the right contents are not touched; with any
+        (like `mode` or `owner`), every file is checked by M(copy).
     required: false
 """
 
@@ -31,4 +68,34 @@ EXAMPLES = r"""
 # Would create `/srv/user_salt/formation.sls` and `/srv/user_salt/formation.top`.
 - qubesformation:
     dest: /srv/user_salt/formation.sls
+
+# Would also create `/srv/user_salt/formation-wave-1.sls`,
+# `/srv/user_salt/formation-wave-2.sls` and so on.
+- qubesformation:
+    dest: /srv/user_salt/formation.sls
+    waves: true
+  register: formation
+
+- qubessls:
+    sls: "{{ item }}"
+    env: user
+  loop: "{{ formation.wave_sls }}"
+
+# Would only describe the VMs and preferences that differ from the dom0.
+- qubesformation:
+    dest: /srv/user_salt/formation.sls
+    prune: true
+"""
+
+RETURN = r"""
+changed_files:
+  description: the files that were written.
+  type: list
+dest:
+  description: every file the formation is made of.
+  type: list
+pruned:
+  description: how many VMs and preferences were left out, with `prune`.
+  type: dict
+  sample: {"vms": 12, "prefs": 40}
 """
@@ -1,6 +1,6 @@
 DOCUMENTATION = """
 ---
-module: qubesformation
+module: qubessls
 author: Manuel Amador (Rudd-O) <rudd-o@rudd-o.com>
 short_description: provision VMs via a generated Qubes Salt Management recipe.
 version_added: 0.0
@@ -20,6 +20,34 @@ options:
     required: false
     description:
       - Which Salt environment to load the SLS from (default `base`, you can specify `user`).
+  targets:
+    required: false
+    description:
+      - The VMs to realize the recipe in, as a list or a comma-separated
+        string, passed to `qubesctl --targets`.  Every VM is reported
+        as soon as qubesctl is done with it, with connections that can
+        hand output over as it comes, like the Qubes connection plugin
+        without `become`.
+  skip_dom0:
+    required: false
+    type: bool
+    default: false
+    description:
+      - Do not realize the recipe in dom0 itself (`qubesctl --skip-dom0`).
+  max_concurrency:
+    required: false
+    description:
+      - How many VMs qubesctl may realize the recipe in at the same time
+        (`qubesctl --max-concurrency`).
+  skip_unchanged:
+    required: false
+    type: bool
+    default: false
+    description:
+      - Do not realize the recipe if neither the SLS file nor the options
+        above changed since it was last realized successfully, as recorded
+        in `/var/lib/qubes/ansible-qubessls` on dom0.  Files the recipe
+        includes are not taken into account, and the SLS file must exist.
 """
 
 EXAMPLES = r"""
@@ -27,4 +55,38 @@ EXAMPLES = r"""
 - qubessls:
     env: base
     sls: formation
+
+# Would realize `/srv/user_salt/formation.sls` in four VMs at a time,
+# but not in dom0, unless it was realized that way already.
+- qubessls:
+    env: user
+    sls: formation
+    targets: "{{ groups['vms'] }}"
+    skip_dom0: true
+    max_concurrency: 4
+    skip_unchanged: true
+
+# In check mode (ansible-playbook --check) qubesctl is not run; the task
+# is reported as changed, unless skip_unchanged finds the recipe was
+# realized already.
+- qubessls:
+    env: user
+    sls: formation
+  check_mode: true
+"""
+
+RETURN = r"""
+vms:
+  description: what qubesctl said of every VM it was done with, by VM.
+  type: dict
+  sample: {"work": "OK", "sys-net": "ERROR (exit code 20, details in /var/log/qubes/mgmt-sys-net.log)"}
+rc:
+  description: the exit code of qubesctl.
+  type: int
+stdout:
+  description: the output of qubesctl.
+  type: str
+stderr:
+  description: the error output of qubesctl.
+  type: str
 """
@@ -2,8 +2,9 @@ from ansible.errors import AnsibleError
 from ansible.plugins.lookup import LookupBase
 
 import json
-import sys
+import os
 import subprocess
+import tempfile
 
 try:
     from __main__ import display
@@ -11,20 +12,101 @@ except ImportError:
     from ansible.utils.display import Display
     display = Display()
 
+# The bindings, unless what got imported is this very file.
+try:
+    import jq as _jq
+    _jq.compile
+except (ImportError, AttributeError):
+    _jq = None
+
 
 UNDEFINED = object()
 
+# Compiled filters, by expression.
+_filters = {}
+
+
+class _Compiled(object):
+    '''A filter compiled by the jq Python bindings, run in this process.'''
+
+    def __init__(self, expr):
+        self.expr = expr
+        try:
+            self.program = _jq.compile(expr)
+        except ValueError as e:
+            raise AnsibleError("jq could not compile %s: %s" % (expr, e))
+
+    def all(self, value):
+        try:
+            run = getattr(self.program, "input_value", None) or self.program.input
+            return run(value).all()
+        except ValueError as e:
+            raise AnsibleError("jq failed on %s: %s" % (self.expr, e))
+
+
+class _Coprocess(object):
+    '''A jq process running one filter over every input sent to it, kept for the life of this process.
+
+    Every input gets one line back: the array of what the filter
+    gave, or an object with the error the filter ran into.
+    '''
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.owner = os.getpid()
+        # Nothing reads stderr until jq dies, so a pipe could fill up
+        # and block it; a file cannot.
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(
+            ["jq", "--unbuffered", "-c", "try [%s\n] catch {error: .}" % (expr,)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr,
+        )
+
+    def all(self, value):
+        try:
+            self.proc.stdin.write(json.dumps(value).encode("utf-8") + b"\n")
+            self.proc.stdin.flush()
+            out = self.proc.stdout.readline()
+        except (IOError, OSError):
+            out = b""
+        if not out:
+            _filters.pop(self.expr, None)
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.stderr.seek(0)
+            err = self.stderr.read()
+            self.stderr.close()
+            raise AnsibleError("jq failed on %s: %s" % (self.expr, err.decode("utf-8", "replace").strip()))
+        result = json.loads(out)
+        if isinstance(result, dict):
+            raise AnsibleError("jq failed on %s: %s" % (self.expr, result["error"]))
+        return result
+
+
+def _filter(expr):
+    '''Return the filter for expr, compiled the first time it is asked for.
+
+    Filters run in this process with the jq Python bindings, if they
+    are installed, and otherwise in a jq process of their own.  Those
+    processes are not shared with processes forked from this one.
+    '''
+    f = _filters.get(expr)
+    if f is None or (isinstance(f, _Coprocess) and f.owner != os.getpid()):
+        f = _filters[expr] = _Compiled(expr) if _jq is not None else _Coprocess(expr)
+    return f
+
 
 class LookupModule(LookupBase):
 
-    def run(self, args, variables):
-        i = json.dumps(args[0])
-        c = ["jq", args[1]]
-        p = subprocess.Popen(c, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        o, e = p.communicate(i)
-        r = p.wait()
-        if r != 0 or e:
-            assert 0, e
-            raise subprocess.CalledProcessError(r, c, o, e)
-        r = json.loads(o)
-        return r
+    def run(self, args, variables=None, batch=False):
+        f = _filter(args[1])
+
+        def one(value):
+            r = f.all(value)
+            if len(r) != 1:
+                raise AnsibleError("jq filter %s gave %d results rather than one" % (args[1], len(r)))
+            return r[0]
+
+        if batch:
+            return [one(value) for value in args[0]]
+        return [one(args[0])]
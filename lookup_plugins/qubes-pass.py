@@ -1,8 +1,20 @@
 from ansible.errors import AnsibleError
 from ansible.plugins.lookup import LookupBase
+from ansible.utils.path import unfrackpath
 
+import base64
+import errno
+import fcntl
+import json
+import multiprocessing
+import os
+import signal
+import socket
 import sys
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from __main__ import display
@@ -13,34 +25,256 @@ except ImportError:
 
 UNDEFINED = object()
 
+# Seconds a looked up entry is kept, unless QUBES_PASS_TTL or ttl= say otherwise.
+TTL = 300
+
+CACHE_DIR = "~/.ansible/cp"
+
+
+def _controller():
+    '''Return the PID of the Ansible process whose run lookups share a cache.'''
+    parent = multiprocessing.parent_process()
+    return parent.pid if parent is not None else os.getpid()
+
+
+def _cache_path():
+    directory = unfrackpath(CACHE_DIR)
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return os.path.join(directory, "qubes-pass-%d" % _controller())
+
+
+def _command(vm, key, create, no_symbols):
+    '''Return the qvm-pass command that looks key up in vm.'''
+    cmd = ['qvm-pass']
+    if vm is not None:
+        cmd += ['-d', vm]
+    if create:
+        cmd += ['get-or-generate']
+        if no_symbols:
+            cmd += ["-n"]
+    cmd += ['--', key]
+    return cmd
+
+
+def _run(cmd):
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    return p.returncode, out
 
-class LookupModule(LookupBase):
 
-    def run(self, args, variables=None, vm=None, create=True, multiline=False, no_symbols=False, default=UNDEFINED):
+class _Cache(object):
+    '''Entries looked up, by (vm, key, create, no_symbols), until they expire.'''
 
-        ret = []
+    def __init__(self):
+        self.entries = {}
+        self.locks = {}
+        self.lock = threading.Lock()
 
-        cmd = ['qvm-pass']
-        if vm is not None:
-            cmd += ['-d', vm]
-        if create:
-            cmd += ['get-or-generate']
-            if no_symbols:
-                cmd += ["-n"]
-        cmd += ['--', args[0]]
+    def get(self, vm, key, create, no_symbols, ttl):
+        entry_key = (vm, key, bool(create), bool(no_symbols))
+        with self.lock:
+            lock = self.locks.setdefault(entry_key, threading.Lock())
+        # Lookups of an entry already being looked up wait for it,
+        # rather than calling qvm-pass again.
+        with lock:
+            entry = self.entries.get(entry_key)
+            if entry is not None and entry[0] > time.time():
+                return 0, entry[1]
+            rc, out = _run(_command(vm, key, create, no_symbols))
+            if rc == 0:
+                self.entries[entry_key] = (time.time() + ttl, out)
+            return rc, out
+
+    def invalidate(self, vm, names):
+        '''Forget the entries named names, or all of them, in vm, or in every VM if vm is None.
+
+        Entries written to the default vault may have been looked up
+        with the name of that vault given explicitly, so, without a
+        vm, the names are forgotten whatever VM they were looked up in.
+        '''
+        with self.lock:
+            for entry_key in list(self.entries):
+                if names is None or (entry_key[1] in names and vm in (None, entry_key[0])):
+                    del self.entries[entry_key]
+
+
+def _handle(cache, client):
+    try:
+        with client, client.makefile("rwb") as f:
+            request = json.loads(f.readline().decode("utf-8"))
+            if request["op"] == "get":
+                try:
+                    rc, out = cache.get(request["vm"], request["key"], request["create"],
+                                        request["no_symbols"], request["ttl"])
+                    reply = {"rc": rc, "out": base64.b64encode(out).decode("ascii")}
+                except OSError as e:
+                    reply = {"error": "%s" % (e,)}
+            elif request["op"] == "invalidate":
+                cache.invalidate(request.get("vm"), request.get("names"))
+                reply = {}
+            else:
+                reply = {}
+            f.write(json.dumps(reply).encode("utf-8") + b"\n")
+            f.flush()
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+
+def _serve_cache(path, controller, ready):
+    '''Keep looked up entries in memory until the Ansible process controller is gone.
+
+    Every client sends one request, a JSON line, over the control
+    socket at path, and gets one back.  Entries are never written to
+    disk.
+    '''
+    try:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.unlink(path)
+        listener.bind(path)
+        listener.listen(64)
+    except (IOError, OSError) as e:
+        os.write(ready, ("cannot listen on %s: %s" % (path, e)).encode("utf-8"))
+        return
+    os.write(ready, b"OK")
+    os.close(ready)
+
+    cache = _Cache()
+    listener.settimeout(1)
+    try:
+        while True:
+            try:
+                os.kill(controller, 0)
+            except OSError:
+                break
+            try:
+                client, _ = listener.accept()
+            except socket.timeout:
+                continue
+            client.settimeout(None)
+            t = threading.Thread(target=_handle, args=(cache, client))
+            t.daemon = True
+            t.start()
+    finally:
+        try:
+            os.unlink(path)
+        except (IOError, OSError):
+            pass
+        listener.close()
 
-        display.vvvv(u"Password lookup using command %s" % cmd)
 
+def _spawn_cache(path):
+    '''Start a detached cache daemon, and wait until it is listening.'''
+    controller = _controller()
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
         try:
-            ret = subprocess.check_output(cmd)
+            os.close(ready_r)
+            os.setsid()
+            if os.fork() == 0:
+                for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                os.closerange(3, ready_w)
+                os.closerange(ready_w + 1, os.sysconf("SC_OPEN_MAX"))
+                _serve_cache(path, controller, ready_w)
+        finally:
+            os._exit(0)
+    os.close(ready_w)
+    os.waitpid(pid, 0)
+    with os.fdopen(ready_r, "rb") as ready:
+        status = ready.read()
+    if status != b"OK":
+        raise AnsibleError("the qubes-pass lookup cache could not start: %s" % (
+            status.decode("utf-8", "replace") or "daemon died unexpectedly",
+        ))
+
+
+def _request(path, request):
+    '''Send request to the cache daemon at path, returning its reply, or None if there is none.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps(request).encode("utf-8") + b"\n")
+            f.flush()
+            reply = f.readline()
+    except (IOError, OSError):
+        return None
+    finally:
+        sock.close()
+    try:
+        return json.loads(reply.decode("utf-8"))
+    except ValueError:
+        return None
+
+
+def _ensure_cache(path):
+    '''Start the cache daemon at path, unless it is running already.'''
+    if _request(path, {"op": "ping"}) is not None:
+        return
+    with open(path + ".lock", "wb") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another fork may have started the daemon while we waited.
+        if _request(path, {"op": "ping"}) is None:
+            _spawn_cache(path)
+
+
+def invalidate(names=None, vm=None):
+    '''Forget the entries named names, or all of them, in vm or in every VM, if the cache is running.'''
+    _request(_cache_path(), {"op": "invalidate", "vm": vm, "names": names})
+
+
+class LookupModule(LookupBase):
+
+    def run(self, args, variables=None, vm=None, create=True, multiline=False, no_symbols=False, default=UNDEFINED, ttl=None, parallelism=8):
+
+        if ttl is None:
+            ttl = float(os.environ.get("QUBES_PASS_TTL", TTL))
+        path = None
+        if ttl > 0:
+            # Started before any thread is, since it forks.
+            path = _cache_path()
+            _ensure_cache(path)
+
+        def lookup(key):
+            cmd = _command(vm, key, create, no_symbols)
+
+            display.vvvv(u"Password lookup using command %s" % cmd)
+
+            if path is None:
+                try:
+                    rc, ret = _run(cmd)
+                except OSError as e:
+                    raise AnsibleError("qubes-pass lookup failed: %s" % (e,))
+            else:
+                reply = _request(path, {"op": "get", "vm": vm, "key": key, "create": create,
+                                        "no_symbols": no_symbols, "ttl": ttl})
+                if reply is None:
+                    raise AnsibleError("the qubes-pass lookup cache at %s went away" % path)
+                if "error" in reply:
+                    raise AnsibleError("qubes-pass lookup failed: %s" % (reply["error"],))
+                rc, ret = reply["rc"], base64.b64decode(reply["out"])
+            if rc == 8:
+                if create or default is UNDEFINED:
+                    raise AnsibleError("qubes-pass could not locate password entry %s in store" % key)
+                return default
+            elif rc != 0:
+                raise AnsibleError("qubes-pass lookup failed: %s" % subprocess.CalledProcessError(rc, cmd))
             if not multiline:
                 ret = ret[:-1].decode("utf-8")
-        except subprocess.CalledProcessError as e:
-            if e.returncode == 8:
-                if create or default is UNDEFINED:
-                    raise AnsibleError("qubes-pass could not locate password entry %s in store" % args[0])
-                return [default]
-            else:
-                raise AnsibleError("qubes-pass lookup failed: %s" % e)
+            return ret
+
+        # Every key is looked up at the same time as parallelism - 1 others.
+        with ThreadPoolExecutor(max_workers=int(parallelism)) as pool:
+            return list(pool.map(lookup, args))
 
-        return [ret]
+    def invalidate(self, names=None, vm=None):
+        invalidate(names, vm)